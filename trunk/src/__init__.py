@@ -1 +1 @@
-__all__ = ['etcproposals_lib', 'etcproposals_shell', 'portage_stubs']
+__all__ = ['etcproposals_lib', 'etcproposals_shell', 'etcproposals_diff', 'portage_stubs']
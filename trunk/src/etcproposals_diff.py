@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+# Copyright 2006, 2007 Björn Michaelsen
+# Distributed under the terms of the GNU General Public License v2
+
+# etc-proposals - line diff engines, all returning difflib style opcodes
+
+import difflib
+
+
+class DifflibEngine(object):
+    "diffs using difflib.SequenceMatcher"
+    @staticmethod
+    def get_opcodes(base_lines, proposed_lines):
+        return difflib.SequenceMatcher(None, base_lines, proposed_lines).get_opcodes()
+
+
+class EditCostExceeded(Exception):
+    pass
+
+
+class MyersEngine(object):
+    """diffs using the linear space variant of the Myers algorithm. Lines are
+    hashed to integer ids first and common prefixes and suffixes are stripped
+    before searching for the middle snake of the remaining region. The search
+    takes time proportional to the size of the files times the number of
+    changed lines, so heavily rewritten files are left to difflib once more
+    than max_cost diagonals have been followed."""
+    max_cost = 200000
+
+    @staticmethod
+    def get_opcodes(base_lines, proposed_lines):
+        (a, b) = MyersEngine._get_line_ids(base_lines, proposed_lines)
+        try:
+            return opcodes_from_matching_blocks(MyersEngine._get_matching_blocks(a, b, MyersEngine.max_cost))
+        except EditCostExceeded:
+            return DifflibEngine.get_opcodes(base_lines, proposed_lines)
+
+    @staticmethod
+    def _get_line_ids(base_lines, proposed_lines):
+        line_ids = dict()
+        a = [line_ids.setdefault(line, len(line_ids)) for line in base_lines]
+        b = [line_ids.setdefault(line, len(line_ids)) for line in proposed_lines]
+        return (a, b)
+
+    @staticmethod
+    def _get_matching_blocks(a, b, max_cost):
+        blocks = list()
+        cost = [max_cost]
+        regions = [(0, len(a), 0, len(b))]
+        while regions:
+            (alo, ahi, blo, bhi) = regions.pop()
+            prefix = 0
+            while alo + prefix < ahi and blo + prefix < bhi and a[alo + prefix] == b[blo + prefix]:
+                prefix += 1
+            if prefix:
+                blocks.append((alo, blo, prefix))
+                (alo, blo) = (alo + prefix, blo + prefix)
+            suffix = 0
+            while alo < ahi - suffix and blo < bhi - suffix and a[ahi - suffix - 1] == b[bhi - suffix - 1]:
+                suffix += 1
+            if suffix:
+                blocks.append((ahi - suffix, bhi - suffix, suffix))
+                (ahi, bhi) = (ahi - suffix, bhi - suffix)
+            if alo == ahi or blo == bhi:
+                continue
+            if not set(a[alo:ahi]).intersection(b[blo:bhi]):
+                continue
+            split = MyersEngine._bisect(a, alo, ahi, b, blo, bhi, cost)
+            if split is not None:
+                (x, y) = split
+                regions.append((alo, x, blo, y))
+                regions.append((x, ahi, y, bhi))
+        blocks.sort()
+        return MyersEngine._join_adjacent_blocks(blocks) + [(len(a), len(b), 0)]
+
+    @staticmethod
+    def _bisect(a, alo, ahi, b, blo, bhi, cost):
+        """returns the point where the forward and the reverse path overlap or None, if there is no common line.
+        Raises EditCostExceeded, once the diagonals followed use up the remaining cost."""
+        (n, m) = (ahi - alo, bhi - blo)
+        max_d = (n + m + 1) // 2
+        (v_offset, v_length) = (max_d, 2 * max_d + 2)
+        v1 = [-1] * v_length
+        v1[v_offset + 1] = 0
+        v2 = v1[:]
+        delta = n - m
+        front = (delta % 2 != 0)
+        (k1start, k1end, k2start, k2end) = (0, 0, 0, 0)
+        for d in xrange(max_d):
+            cost[0] -= 2 * d + 2
+            if cost[0] < 0:
+                raise EditCostExceeded
+            for k1 in xrange(-d + k1start, d + 1 - k1end, 2):
+                k1_offset = v_offset + k1
+                if k1 == -d or (k1 != d and v1[k1_offset - 1] < v1[k1_offset + 1]):
+                    x1 = v1[k1_offset + 1]
+                else:
+                    x1 = v1[k1_offset - 1] + 1
+                y1 = x1 - k1
+                while x1 < n and y1 < m and a[alo + x1] == b[blo + y1]:
+                    (x1, y1) = (x1 + 1, y1 + 1)
+                v1[k1_offset] = x1
+                if x1 > n:
+                    k1end += 2
+                elif y1 > m:
+                    k1start += 2
+                elif front:
+                    k2_offset = v_offset + delta - k1
+                    if 0 <= k2_offset < v_length and v2[k2_offset] != -1:
+                        if x1 >= n - v2[k2_offset]:
+                            return (alo + x1, blo + y1)
+            for k2 in xrange(-d + k2start, d + 1 - k2end, 2):
+                k2_offset = v_offset + k2
+                if k2 == -d or (k2 != d and v2[k2_offset - 1] < v2[k2_offset + 1]):
+                    x2 = v2[k2_offset + 1]
+                else:
+                    x2 = v2[k2_offset - 1] + 1
+                y2 = x2 - k2
+                while x2 < n and y2 < m and a[ahi - x2 - 1] == b[bhi - y2 - 1]:
+                    (x2, y2) = (x2 + 1, y2 + 1)
+                v2[k2_offset] = x2
+                if x2 > n:
+                    k2end += 2
+                elif y2 > m:
+                    k2start += 2
+                elif not front:
+                    k1_offset = v_offset + delta - k2
+                    if 0 <= k1_offset < v_length and v1[k1_offset] != -1:
+                        x1 = v1[k1_offset]
+                        if x1 >= n - x2:
+                            return (alo + x1, blo + x1 - (k1_offset - v_offset))
+        return None
+
+    @staticmethod
+    def _join_adjacent_blocks(blocks):
+        joined_blocks = list()
+        for (i, j, size) in blocks:
+            if joined_blocks:
+                (last_i, last_j, last_size) = joined_blocks[-1]
+                if last_i + last_size == i and last_j + last_size == j:
+                    joined_blocks[-1] = (last_i, last_j, last_size + size)
+                    continue
+            joined_blocks.append((i, j, size))
+        return joined_blocks
+
+
+class DiffEngines(object):
+    @staticmethod
+    def get_opcodes(engine, base_lines, proposed_lines):
+        "returns the opcodes to turn base_lines into proposed_lines using the named engine"
+        return {
+            'difflib' : DifflibEngine.get_opcodes,
+            'myers' : MyersEngine.get_opcodes
+            }[engine](base_lines, proposed_lines)
+
+
+def opcodes_from_matching_blocks(matching_blocks):
+    "turns (i, j, size) blocks ending with a (len(a), len(b), 0) sentinel into difflib.SequenceMatcher.get_opcodes() tuples"
+    (i, j, opcodes) = (0, 0, list())
+    for (ai, bj, size) in matching_blocks:
+        if i < ai and j < bj:
+            opcodes.append(('replace', i, ai, j, bj))
+        elif i < ai:
+            opcodes.append(('delete', i, ai, j, bj))
+        elif j < bj:
+            opcodes.append(('insert', i, ai, j, bj))
+        (i, j) = (ai + size, bj + size)
+        if size:
+            opcodes.append(('equal', ai, i, bj, j))
+    return opcodes
+
+
+__all__ = ['DiffEngines', 'DifflibEngine', 'MyersEngine']
+
+if __name__ == '__main__':
+    raise SystemExit, 'This module is not executable.'
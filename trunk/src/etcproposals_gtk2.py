@@ -497,15 +497,19 @@ class ChangesView(gtk.VBox):
 class FilesystemTreeView(gtk.TreeView):
     """FilesystemTreeView implements the Treeview for selecting files and changes."""
     def __init__(self, proposals):
-        self.treestore = gtk.TreeStore(str)
+        self.treestore = gtk.TreeStore(str, str)
         gtk.TreeView.__init__(self, self.treestore)
         self.column = gtk.TreeViewColumn('')
         self.cell = gtk.CellRendererText()
+        self.countcell = gtk.CellRendererText()
+        self.countcell.props.foreground = 'gray'
         self.proposals = proposals
-        self.treestore.append(None, ['/'])
+        self.treestore.append(None, ['/', ''])
         self.fsrow = self.treestore[0]
         self.column.pack_start(self.cell, True)
         self.column.add_attribute(self.cell, 'text', 0)
+        self.column.pack_start(self.countcell, False)
+        self.column.add_attribute(self.countcell, 'text', 1)
         self.append_column(self.column)
         self.props.headers_visible = False
         self.refresh()
@@ -522,13 +526,15 @@ class FilesystemTreeView(gtk.TreeView):
     def refresh(self):
         [self.treestore.remove(row.iter) for row in self.fsrow.iterchildren()]
         for file in self.proposals.get_files():
-            parent=self.fsrow
+            (parent, path) = (self.fsrow, '/')
             for part in file[1:].split('/'):
+                path = os.path.join(path, part)
                 rows = [row for row in parent.iterchildren() if row[0]==part]
                 if len(rows)==1:
                     parent = rows[0]
                 else:
-                    parent = self.treestore[self.treestore.append(parent.iter, [part])]
+                    parent = self.treestore[self.treestore.append(parent.iter,
+                        [part, '(%d)' % self.proposals.get_dir_proposal_count(path)])]
         self.expand_all()
 
     def get_changegenerator_for_node(self, node):
@@ -840,6 +846,7 @@ class EtcProposalsController(object):
         self.changesview = self.view.changesview
         self.treeview = self.view.treeview
         self.popupmenu = self.view.popupmenu
+        self.state_flush_scheduled = False
         self.__register_events()
         self.refresh()
 
@@ -858,14 +865,28 @@ class EtcProposalsController(object):
     def undo_change(self, change):
         change.undo()
         self.view.update_changes()
+        self.schedule_state_flush()
 
     def zap_change(self, change):
         change.zap()
         self.view.update_changes()
+        self.schedule_state_flush()
 
     def use_change(self, change):
         change.use()
         self.view.update_changes()
+        self.schedule_state_flush()
+
+    def schedule_state_flush(self):
+        "writes the decisions to the state file, when gtk is idle"
+        if not self.state_flush_scheduled:
+            self.state_flush_scheduled = True
+            gobject.idle_add(self.flush_state)
+
+    def flush_state(self):
+        self.state_flush_scheduled = False
+        self.proposals.flush_state()
+        return False
 
     def apply(self):
         def apply_callback(current_file):
@@ -904,6 +925,7 @@ class EtcProposalsController(object):
         wait_win.refreshing_views()
         self.view.update_changes()
         wait_win.destroy()
+        self.schedule_state_flush()
 
     def on_zap_selection(self):
         wait_win = WaitWindow()
@@ -916,6 +938,7 @@ class EtcProposalsController(object):
         wait_win.refreshing_views()
         self.view.update_changes()
         wait_win.destroy()
+        self.schedule_state_flush()
 
     def on_use_selection(self):
         wait_win = WaitWindow()
@@ -927,6 +950,7 @@ class EtcProposalsController(object):
         wait_win.refreshing_views()
         self.view.update_changes()
         wait_win.destroy()
+        self.schedule_state_flush()
 
     def on_new_changeview(self, changesview, changeview):
         changeview.status.connect('use-change', lambda changeview: self.use_change(changeview.change))
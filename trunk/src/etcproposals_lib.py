@@ -9,10 +9,39 @@ __author__ = 'Björn Michaelsen'
 __version__ = '1.4.3'
 __date__ = '2008-11-30'
 
-import ConfigParser, anydbm, shelve, difflib, os, os.path, re, shutil, hashlib
+import ConfigParser, anydbm, whichdb, shelve, cPickle, errno, os, os.path, sys, re, shutil, hashlib, time, bisect, mmap, array, itertools, atexit, fnmatch
 from etcproposals.portage_stubs import PortageInterface
+from etcproposals.etcproposals_diff import DiffEngines
+
+try:
+    import multiprocessing, multiprocessing.pool
+except ImportError:
+    multiprocessing = None
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+try:
+    from sys import getsizeof
+except ImportError:
+    getsizeof = None
     
 STATEFILE = '/var/state/etcproposals.state'
+DIFFCACHEFILE = os.path.join(os.path.dirname(STATEFILE), 'etcproposals.diffcache')
+CONFIGFILESTATEFILE = os.path.join(os.path.dirname(STATEFILE), 'etcproposals.configfiles')
+FINGERPRINTSTATEFILE = os.path.join(os.path.dirname(STATEFILE), 'etcproposals.fingerprints')
+SQLITESTATEFILE = os.path.join(os.path.dirname(STATEFILE), 'etcproposals.sqlite')
+JOURNALFILE = os.path.join(os.path.dirname(STATEFILE), 'etcproposals.journal')
+SCANCACHEFILE = os.path.join(os.path.dirname(STATEFILE), 'etcproposals.scancache')
+# the memory used by an empty string object
+STRING_OVERHEAD = 40
 
 
 class OpcodeMismatchException(Exception):
@@ -26,8 +55,11 @@ class FrontendFailedException(Exception):
 
 
 class EtcProposalChange(object):
+    __slots__ = ['opcode', 'proposal', 'merge', 'touched', 'flags', 'content_hash']
+
     def __init__(self, opcode, proposal):
         (self.opcode, self.proposal, self.merge, self.touched) = (opcode, proposal, False, (opcode[0] == 'equal'))
+        (self.flags, self.content_hash) = (0, None)
 
     def __getstate__(self):
         return (self.opcode, self.merge, self.touched)
@@ -55,6 +87,13 @@ class EtcProposalChange(object):
         (self.touched, self.merge) = ((self.opcode[0] == 'equal'), False)
         self.on_changed()
 
+    def set_status(self, status):
+        "sets the status (undecided/use/zap) of a change without firing on_changed"
+        (self.touched, self.merge) = {
+            'undecided' : (False, False),
+            'use' : (True, True),
+            'zap' : (True, False) }[status]
+
     def get_file_path(self):
         "path to the config file, which this change proposes to change"
         return self.proposal.get_file_path()
@@ -85,9 +124,19 @@ class EtcProposalChange(object):
 
     def get_filepart_content(self):
         "the file content, as it would be merged with the current zap/use decision"
+        return list(self._get_filepart_lines())
+
+    def get_filepart_text(self):
+        "the file content, as it would be merged with the current zap/use decision, as one string"
         if self.merge:
-            return self.get_proposed_content()
-        return self.get_base_content()
+            return self.proposal.get_proposed_text(self.opcode)
+        return self.proposal.get_base_text(self.opcode)
+
+    def _get_filepart_lines(self):
+        "like get_filepart_content, but as they are stored by the proposal"
+        if self.merge:
+            return self.proposal._get_proposed_content()[self.opcode[3]:self.opcode[4]]
+        return self.proposal._get_base_content()[self.opcode[1]:self.opcode[2]]
 
     def get_status(self):
         "returns the status of the change (undecided/use/zap)"
@@ -97,79 +146,81 @@ class EtcProposalChange(object):
             return 'use'
         return 'zap'
 
+    def get_sort_key(self):
+        "orders the changes like EtcProposals.get_all_changes()"
+        return (self.proposal.sort_key, self.opcode[1], self.opcode[3])
+
+    def get_content_hash(self):
+        "a short hash of the base and the proposed content of the change"
+        if self.content_hash is None:
+            self.content_hash = hashlib.md5(
+                self.proposal.get_base_text(self.opcode) + '\0' +
+                self.proposal.get_proposed_text(self.opcode)).digest()[:EtcProposalDecisions.HASHSIZE]
+        return self.content_hash
+
     def is_nullchange(self):
         "True, if the change describes a unchanged filepart"
         return (self.opcode[0] == 'equal')
 
     def is_whitespace_only(self):
         "True, if the change only modifies whitespace file content"
-        if self.proposal.proposals._whitespace_changes != None:
-            return self in self.proposal.proposals._whitespace_changes
-        return self._contains_only_matching_lines('^\s*$')
+        return bool(self.flags & EtcProposalChange.WHITESPACE)
 
     def is_cvsheader(self):
         "True, if the change only modifies a CVS header"
-        if self.proposal.proposals._cvsheader_changes != None:
-            return self in self.proposal.proposals._cvsheader_changes
-        return self._contains_only_matching_lines('^# .Header:.*$')
+        return bool(self.flags & EtcProposalChange.CVSHEADER)
 
     def is_unmodified(self):
         "True, if the change should change a config file, which has not been changed (its the same as the one provided with the package"
-        if self.proposal.proposals._unmodified_changes != None:
-            return self in self.proposal.proposals._unmodified_changes
-        return EtcProposalConfigFile(self.proposal.get_file_path()).is_unmodified()
+        return bool(self.flags & EtcProposalChange.UNMODIFIED)
     
+    def classify_content(self):
+        "returns the WHITESPACE and CVSHEADER flags matching the content of the change"
+        flags = EtcProposalChange.WHITESPACE | EtcProposalChange.CVSHEADER
+        for line in itertools.chain(self.get_base_content(), self.get_proposed_content()):
+            if not EtcProposalChange.WHITESPACE_REGEXP.match(line):
+                flags &= ~EtcProposalChange.WHITESPACE
+            if not EtcProposalChange.CVSHEADER_REGEXP.match(line):
+                flags &= ~EtcProposalChange.CVSHEADER
+            if not flags:
+                break
+        return flags
+
     def on_changed(self):
         "Event, should be fired, if the change changes ;-)"
-        self.proposal.on_changed()
+        self.proposal.on_changed(self)
 
-    def _contains_only_matching_lines(self, regexpstring):
-        regexp = re.compile(regexpstring)
-        for line in self.get_base_content() + self.get_proposed_content():
-            if not regexp.match(line):
-                return False
-        return True
+    # flags
+    WHITESPACE = 1
+    CVSHEADER = 2
+    UNMODIFIED = 4
+
+    WHITESPACE_REGEXP = re.compile('^\s*$')
+    CVSHEADER_REGEXP = re.compile('^# .Header:.*$')
 
 
 class EtcProposal(object):
+    __slots__ = ['path', 'proposals', 'file_path', 'revision', 'sort_key', 'fingerprints', 'base_lines', '_changes', '_diff_cache_key']
+
     def __init__(self, path, proposals):
         (self.path, self.proposals) = (os.path.abspath(path), proposals)
-        (self.base_lines, self._changes) = (None, None)
+        (dir, filename) = os.path.split(self.path)
+        self.file_path = os.path.join(dir, EtcProposal.proposal_regexp().match(filename).groups()[0])
+        self.revision = int(filename[5:9])
+        self.sort_key = (dir, self.file_path, self.revision)
+        (self.fingerprints, self.base_lines, self._changes, self._diff_cache_key) = (None, None, None, None)
 
     def __cmp__(self, other):
-        pathcmp = cmp(os.path.dirname(self.path), os.path.dirname(other.path))
-        if pathcmp:
-            return pathcmp
-        filenamecmp = cmp(self.get_file_path(), other.get_file_path())
-        if filenamecmp:
-            return filenamecmp
-        return cmp(self.get_revision(), other.get_revision())
+        return cmp(self.sort_key, other.sort_key)
 
     def apply(self):
         "merges all decisions for this proposal (and those with lower revisions)"
-        file_path = self.get_file_path()
-        merged_configpath = file_path + '.merged'
-        bak_configpath = file_path + '.bak'
-        fd = open(merged_configpath, 'w')
-        fd.writelines(self.get_merged_content())
-        fd.close()
-        try:
-            shutil.copymode(file_path, merged_configpath)
-            shutil.copystat(file_path, merged_configpath)
-            shutil.move(file_path, bak_configpath)
-        except OSError:
-            pass
-        shutil.move(merged_configpath, file_path)
-        try:
-            os.unlink(file_path + '.bak')
-        except OSError:
-            pass
-        self.base_lines = None
-        self._changes = None
-        try:
-            os.unlink(self.path)
-        except OSError:
-            pass
+        ApplyJournal.apply([(self.get_file_path(), self.get_merged_chunks(), [self.path])])
+        self.on_applied()
+
+    def on_applied(self):
+        "Event, should be fired, after the proposal has been merged into the config file"
+        (self.base_lines, self._changes, self._diff_cache_key) = (None, None, None)
         self.clear_state()
     
     def clear_state(self):
@@ -178,15 +229,14 @@ class EtcProposal(object):
 
     def clear_cache(self):
         "clears all state data"
-        self.on_changed()
-        self.base_lines = None
-        self._changes = None
+        if not self._changes is None:
+            decisions = self._get_decisions()
+            State.defer(self._get_state_url(), lambda: decisions)
+        (self.base_lines, self._changes, self._diff_cache_key) = (None, None, None)
 
     def get_file_path(self):
         "path to the config file, which this proposal proposes to change"
-        return os.path.join(
-            os.path.dirname(self.path),
-            EtcProposal.proposal_regexp().match(os.path.basename(self.path)).groups()[0]) 
+        return self.file_path
 
     def get_proposal_path(self):
         "path to the proposal"
@@ -194,71 +244,119 @@ class EtcProposal(object):
     
     def get_revision(self):
         "the number in the ._cfgXXXX_ part of a proposals filename"
-        return int(os.path.basename(self.path)[5:9])
+        return self.revision
 
     def get_base_content(self):
         "the current (old) file content"
-        if self.base_lines is None:
-            baseproposal = self.proposals.get_previous_proposal(self)
-            if baseproposal is None:
-                try:
-                    self.base_lines = self._get_file_content(self.get_file_path())
-                except IOError:
-                    self.base_lines = []
-            else:
-                self.base_lines = baseproposal.get_merged_content()
-        return self.base_lines
+        return list(self._get_base_content())
 
     def get_proposed_content(self):
         "the proposed (new) file content"
-        return self._get_file_content(self.path)
+        return list(self._get_proposed_content())
 
     def get_merged_content(self):
         "the file content, as it would be merged with the current zap/use decisions"
+        return list(self._get_merged_content())
+
+    def merge(self):
+        "merges the file content with the current zap/use decisions without using the revision chain cache"
         self._refresh_changes_cache()
-        filelines = list()
-        [filelines.extend(change.get_filepart_content()) for change in self._changes]
-        return filelines
+        return join_lines([change._get_filepart_lines() for change in self._changes])
+
+    def get_merged_chunks(self):
+        "generates the merged file content one change at a time, without splitting it into lines"
+        self._refresh_changes_cache()
+        for change in self._changes:
+            yield change.get_filepart_text()
 
     def get_changes(self):
         self._refresh_changes_cache()
         return [change for change in self._changes if not change.is_nullchange()]
 
     def get_base_lines(self, opcode):
-        return self.get_base_content()[opcode[1]:opcode[2]]
+        return list(self._get_base_content()[opcode[1]:opcode[2]])
 
     def get_proposed_lines(self, opcode):
-        return self.get_proposed_content()[opcode[3]:opcode[4]]
+        return list(self._get_proposed_content()[opcode[3]:opcode[4]])
+
+    def get_base_text(self, opcode):
+        return get_text(self._get_base_content(), opcode[1], opcode[2])
+
+    def get_proposed_text(self, opcode):
+        return get_text(self._get_proposed_content(), opcode[3], opcode[4])
 
     def is_finished(self):
         "True, if all changes have been decided on"
+        self._validate()
         if self._changes is None:
             return False
         return reduce(lambda x,y: x and y, (change.touched for change in self._changes))
 
-    def on_changed(self):
-        "Event, should be fired, if the proposal changes"
+    def on_changed(self, change = None):
+        "Event, should be fired, if the proposal or one of its changes changes"
         self._refresh_changes_cache()
-        undecorated_changes = list()
-        for change in self._changes:
-            undecorated_change = EtcProposalChange(change.opcode, None)
-            undecorated_change.copystatefrom(change)
-            undecorated_changes.append(undecorated_change)
-        State[self._get_state_url()] = undecorated_changes    
-        self.proposals.on_proposal_changed(self)
+        State.defer(self._get_state_url(), self._get_decisions)
+        self.proposals.on_proposal_changed(self, change)
+
+    def _get_decisions(self):
+        return EtcProposalDecisions.encode(
+            self._get_diff_cache_key(),
+            [change for change in self._changes if not change.is_nullchange()])
+
+    def _validate(self):
+        "clears the cache, if the content this proposal is based on changed"
+        chain = self.proposals.get_revision_chain(self.get_file_path())
+        # the config file or the proposal might have been edited since they were diffed
+        fingerprints = (get_optional_fingerprint(self.get_file_path()), get_optional_fingerprint(self.path))
+        if fingerprints != self.fingerprints:
+            (outdated, self.fingerprints) = (not self.fingerprints is None, fingerprints)
+            if outdated:
+                chain.invalidate(self)
+                self.proposals.clear_cache()
+        chain.validate(self)
 
     def _refresh_changes_cache(self):
-        if self._changes is None:
-            opcodes = self._get_opcodes()
-            if len(opcodes) > Config.MaxChangesPerProposal:
-                opcodes = [self._join_opcodes(opcodes)]
-            self._changes = [self._create_change(opcode) for opcode in opcodes]
-            if State.has_key(self._get_state_url()):
-                try:
-                    undecorated_changes = State[self._get_state_url()]
-                    [change.copystatefrom(undecorated_changes.pop(0)) for change in self._changes]
-                except Exception:
-                    pass
+        self._validate()
+        if self._changes is None and not self._init_changes_from_diff_cache():
+            self._init_changes(self._get_opcodes())
+
+    def _init_changes_from_diff_cache(self):
+        "creates the changes from a previous diff of the same contents, returns False if there is none"
+        cached_diff = DiffCache.lookup(self._get_diff_cache_key())
+        if cached_diff is None:
+            return False
+        (opcodes, content_flags) = cached_diff
+        self._init_changes(opcodes, content_flags)
+        return True
+
+    def _init_changes(self, opcodes, content_flags = None):
+        "creates and classifies the changes from the opcodes and restores their state"
+        if len(opcodes) > Config.MaxChangesPerProposal:
+            opcodes = [self._join_opcodes(opcodes)]
+        self._changes = [self._create_change(opcode) for opcode in opcodes]
+        if content_flags is None:
+            content_flags = [change.classify_content() for change in self._changes]
+            DiffCache.store(self._get_diff_cache_key(), opcodes, content_flags)
+        file_flags = 0
+        if EtcProposalConfigFile(self.get_file_path()).is_unmodified():
+            file_flags = EtcProposalChange.UNMODIFIED
+        for (change, flags) in zip(self._changes, content_flags):
+            change.flags = flags | file_flags
+        # the hashes are taken now, the files might have changed when the decisions are stored
+        [change.get_content_hash() for change in self._changes if not change.is_nullchange()]
+        if State.has_key(self._get_state_url()):
+            try:
+                decisions = State[self._get_state_url()]
+                if isinstance(decisions, list):
+                    # older versions stored the pickled changes
+                    [change.copystatefrom(decisions.pop(0)) for change in self._changes]
+                else:
+                    EtcProposalDecisions.restore(
+                        decisions,
+                        self._get_diff_cache_key(),
+                        [change for change in self._changes if not change.is_nullchange()])
+            except Exception:
+                pass
 
     def _join_opcodes(self, opcodes):
         return (
@@ -271,14 +369,44 @@ class EtcProposal(object):
     def _get_state_url(self):
         return 'EtcProposal://' + self.path
 
+    def _get_diff_cache_key(self):
+        if self._diff_cache_key is None:
+            self._diff_cache_key = DiffCache.get_key(self._get_base_content(), self._get_proposed_content())
+        return self._diff_cache_key
+
+    # the contents as they are stored, PooledLines or LineBuffers rather than lists
+    def _get_base_content(self):
+        self._validate()
+        if self.base_lines is None:
+            baseproposal = self.proposals.get_previous_proposal(self)
+            if baseproposal is None:
+                try:
+                    self.base_lines = self._get_file_content(self.get_file_path())
+                except IOError:
+                    self.base_lines = []
+            else:
+                self.base_lines = baseproposal._get_merged_content()
+        return self.base_lines
+
+    def _get_proposed_content(self):
+        return self._get_file_content(self.path)
+
+    def _get_merged_content(self):
+        return self.proposals.get_revision_chain(self.get_file_path()).get_merged_content(self)
+
     def _get_file_content(self, filepath):
-        return FileCache.readlines_from_file(filepath)
+        return FileCache.readlines_from_file(filepath, self.proposals.get_line_pool())
+
+    def _get_diff_contents(self):
+        "the base and proposed content as line ids, if both are in the same line pool"
+        (base_lines, proposed_lines) = (self._get_base_content(), self._get_proposed_content())
+        if isinstance(base_lines, PooledLines) and isinstance(proposed_lines, PooledLines) \
+            and base_lines.pool is proposed_lines.pool:
+            return (base_lines.ids, proposed_lines.ids)
+        return (base_lines, proposed_lines)
 
     def _get_opcodes(self):
-        return difflib.SequenceMatcher(
-            None,
-            self.get_base_content(),
-            self.get_proposed_content()).get_opcodes()
+        return get_opcodes(self._get_diff_contents())
 
     def _create_change(self, opcode):
         return EtcProposalChange(opcode, self)
@@ -290,13 +418,51 @@ class EtcProposal(object):
         return re.compile('^\._cfg[0-9]{4}_(.*)')
 
 
+class EtcProposalDecisions(object):
+    """the decisions on the changes of a proposal, as they are kept in the
+    state: (proposal hash, hunk hashes, statuses). The hunk hashes are the
+    concatenated content hashes of the changes, the statuses are packed with
+    2 bits per change. Decisions are restored by position, if the proposal
+    hash still matches, and by the content hash of the changes otherwise, so
+    they survive shifted opcodes."""
+    HASHSIZE = 8
+    STATUSES = ['undecided', 'use', 'zap']
+
+    @staticmethod
+    def encode(proposal_hash, changes):
+        "returns the record for the statuses of the changes"
+        packed = array.array('B', [0] * ((len(changes) + 3) // 4))
+        for (index, change) in enumerate(changes):
+            packed[index // 4] |= EtcProposalDecisions.STATUSES.index(change.get_status()) << (2 * (index % 4))
+        return (proposal_hash, ''.join([change.get_content_hash() for change in changes]), packed.tostring())
+
+    @staticmethod
+    def restore(record, proposal_hash, changes):
+        "sets the statuses of the changes from a record"
+        (record_hash, hunk_hashes, packed) = record
+        packed = array.array('B', packed)
+        statuses = [EtcProposalDecisions.STATUSES[(packed[index // 4] >> (2 * (index % 4))) & 3]
+            for index in xrange(len(hunk_hashes) // EtcProposalDecisions.HASHSIZE)]
+        if record_hash == proposal_hash and len(statuses) == len(changes):
+            [change.set_status(status) for (change, status) in zip(changes, statuses)]
+            return
+        hunk_statuses = dict()
+        for (index, status) in enumerate(statuses):
+            hunk_hash = hunk_hashes[index * EtcProposalDecisions.HASHSIZE:(index + 1) * EtcProposalDecisions.HASHSIZE]
+            hunk_statuses.setdefault(hunk_hash, []).append(status)
+        for change in changes:
+            statuses_for_hunk = hunk_statuses.get(change.get_content_hash())
+            if statuses_for_hunk:
+                change.set_status(statuses_for_hunk.pop(0))
+
+
 class EtcProposalConfigFile(object):
     def __init__(self, path):
         self.path = path
 
     def md5hexdigest(self):
         "calculates the md5sum of the file in the fs"
-        return hashlib.md5(open(self.path).read()).hexdigest()
+        return FingerprintCache.md5hexdigest(self.path)
     
     def is_unmodified(self):
         "True, if the file in the fs has the same md5 as recorded"
@@ -323,20 +489,83 @@ class EtcProposalConfigFile(object):
         return 'EtcProposalConfigFile://' + self.path
 
 
+class EtcProposalFingerprintCache(dict):
+    """remembers the md5s of files as long as their stat data doesnt change.
+    The md5s can also be kept in the state db across sessions, they are
+    written with the next flush of the state."""
+    CHUNKSIZE = 64 * 1024
+    # files modified that recently might change again without changing their stat data
+    RACY_SECONDS = 2
+
+    def __init__(self, persistent):
+        dict.__init__(self)
+        (self.persistent, self.hits, self.misses) = (persistent, 0, 0)
+
+    def md5hexdigest(self, path):
+        "returns the md5sum of a file, calculating it only if the file changed"
+        fingerprint = get_fingerprint(path)
+        md5 = self._lookup(path, fingerprint)
+        if not md5 is None:
+            self.hits += 1
+            return md5
+        self.misses += 1
+        md5 = self._calculate_md5hexdigest(path)
+        if time.time() - fingerprint[3] > self.RACY_SECONDS:
+            self[path] = (fingerprint, md5)
+            if self.persistent:
+                State.defer(self._get_state_url(path), lambda: (fingerprint, md5))
+        return md5
+
+    def _lookup(self, path, fingerprint):
+        if not self.has_key(path) and self.persistent and State.has_key(self._get_state_url(path)):
+            self[path] = State[self._get_state_url(path)]
+        if self.has_key(path) and self[path][0] == fingerprint:
+            return self[path][1]
+        return None
+
+    def _calculate_md5hexdigest(self, path):
+        md5 = hashlib.md5()
+        fd = open(path, 'rb')
+        try:
+            chunk = fd.read(self.CHUNKSIZE)
+            while chunk:
+                md5.update(chunk)
+                chunk = fd.read(self.CHUNKSIZE)
+        finally:
+            fd.close()
+        return md5.hexdigest()
+
+    def _get_state_url(self, path):
+        return 'EtcProposalFingerprint://' + path
+
+
 class EtcProposals(list):
     def __init__(self, refresh_on_init=True):
         list.__init__(self)
+        self._file_proposals = dict()
+        self._dir_tree = EtcProposalsDirNode()
+        self.line_pool = EtcProposalsLinePool()
         self.clear_cache()
         if refresh_on_init:
             self.refresh()
 
+    def get_line_pool(self):
+        "returns the pool for the lines read from files, starting a new one if it outgrew MaxCachedBytes"
+        if self.line_pool.get_size() > Config.MaxCachedBytes:
+            self._renew_line_pool()
+        return self.line_pool
+
     def refresh(self, current_file_callback = None):
         "clears and repopulates the list from the filesystem"
+        ApplyJournal.recover()
         self.clear_cache()
+        self._renew_line_pool()
         del self[:] 
-        for dir in PortageInterface.get_config_protect(Config.Backend):
-            self._add_update_proposals(dir, current_file_callback)
-        self.sort()
+        (config_protect, config_protect_mask) = PortageInterface.get_config_protect_and_mask(Config.Backend)
+        for proposal_paths in Scanner.scan(config_protect, config_protect_mask):
+            self._add_update_proposals(proposal_paths, current_file_callback)
+        self.sort(key = lambda proposal: proposal.sort_key)
+        self._index_proposals()
 
     def clear_all_states(self):
         "this is pretty much 'undo all' but it also removes orphaned state files"
@@ -348,32 +577,45 @@ class EtcProposals(list):
         self._whitespace_changes = None
         self._cvsheader_changes = None
         self._unmodified_changes = None
-        self._used_changes = None
-        self._zapped_changes = None
-        self._undecided_changes = None
+        self._status_changes = None
+        (self._status_keys, self._change_statuses) = (dict(), dict())
+        self._outdated_proposals = list()
         
     def apply(self, update_unmodified = False, current_file_callback = None):
         "merges all finished proposals"
-        finished_proposals = [proposal for proposal in self if proposal.is_finished()]
-        for proposal in finished_proposals:        
-            if not current_file_callback is None: current_file_callback(proposal.get_file_path())
-            proposal.apply()
+        State.flush()
+        # a later revision is merged on top of the earlier ones, so only the
+        # last finished revision of a file gets written
+        (finished_proposals, file_merges) = (list(), list())
+        for file_path in self.get_files():
+            file_proposals = [proposal for proposal in self.get_file_proposals(file_path) if proposal.is_finished()]
+            if file_proposals:
+                file_merges.append((file_path, file_proposals[-1].get_merged_chunks(), [proposal.path for proposal in file_proposals]))
+                finished_proposals.extend(file_proposals)
+        ApplyJournal.apply(file_merges, current_file_callback)
+        [proposal.on_applied() for proposal in finished_proposals]
         if update_unmodified:
             self.update_unmodified(finished_proposals)
-        State.clear_orphaned(self)
-        self.refresh()
+        self._remove_proposals(finished_proposals)
+        State.clear_orphaned_proposals(self)
+        DiffCache.flush()
+
+    def flush_state(self):
+        "writes the pending decisions to the state file, frontends should call this when idle"
+        State.flush()
+        DiffCache.flush()
 
     def get_files(self):
         "returns a list of config files which have update proposals"
-        configpaths = list(set((
-            proposal.get_file_path() for proposal in self)))
+        configpaths = self._file_proposals.keys()
         configpaths.sort()
         return configpaths
     
     def update_unmodified(self, finished_proposals):
         "records the md5 if it matches the one of the file in the fs"
         finished_filepaths = set((proposal.get_file_path() for proposal in finished_proposals))
-        expected_md5s =  PortageInterface.get_md5_from_vdb(finished_filepaths)
+        expected_md5s =  PortageInterface.get_md5_from_vdb(finished_filepaths, Config.VdbWorkers,
+            PortageInterface.get_config_protect(Config.Backend))
         for (path, expected_md5) in expected_md5s.iteritems():
             EtcProposalConfigFile(path).update_unmodified(expected_md5)
         for path in (finished_filepaths - set(expected_md5s.keys())):
@@ -390,8 +632,7 @@ class EtcProposals(list):
 
     def get_file_proposals(self, file_path):
         "returns a list of proposals for a config file"
-        return [proposal for proposal in self
-            if proposal.get_file_path() == file_path]
+        return list(self._file_proposals.get(file_path, []))
 
     def get_dir_changes(self, dir_path):
         "returns a list of changes for config files in a directory"
@@ -399,11 +640,30 @@ class EtcProposals(list):
 
     def get_dir_changes_gen(self, dir_path):
         "returns a generator of changes for config files in a directory (get a new generator, if you modify changes)"
-        matching_proposals = [proposal for proposal in self
-            if proposal.get_file_path().startswith(dir_path)]
-        return (change for proposal in matching_proposals 
+        return (change for proposal in self.get_dir_proposals(dir_path)
             for change in proposal.get_changes())
 
+    def get_dir_proposals(self, dir_path):
+        "returns a list of proposals for config files in a directory"
+        node = self._dir_tree.get_node(dir_path)
+        if node is None:
+            return []
+        return node.get_proposals()
+
+    def get_dir_file_count(self, dir_path):
+        "returns the number of config files with proposals in a directory"
+        node = self._dir_tree.get_node(dir_path)
+        if node is None:
+            return 0
+        return node.file_count
+
+    def get_dir_proposal_count(self, dir_path):
+        "returns the number of proposals for config files in a directory"
+        node = self._dir_tree.get_node(dir_path)
+        if node is None:
+            return 0
+        return node.proposal_count
+
     def get_all_changes(self):
         "returns a list all changes"
         self._refresh_changes_cache()
@@ -411,124 +671,679 @@ class EtcProposals(list):
 
     def get_whitespace_changes(self):
         "returns a list of changes only changing whitespaces"
-        self._refresh_whitespace_changes_cache()
+        self._refresh_classified_changes_cache()
         return self._whitespace_changes
 
     def get_cvsheader_changes(self):
         "returns a list of changes only changing CVS-Header"
-        self._refresh_cvsheader_changes_cache()
+        self._refresh_classified_changes_cache()
         return self._cvsheader_changes
     
     def get_unmodified_changes(self):
         "returns a list of changes of unmodified files"
-        self._refresh_unmodified_changes_cache()
+        self._refresh_classified_changes_cache()
         return self._unmodified_changes
 
     def get_used_changes(self):
         "returns a list of used changes"
-        self._refresh_used_changes_cache()
-        return self._used_changes
+        return self._get_status_changes('use')
 
     def get_zapped_changes(self):
         "returns a list of zapped changes"
-        self._refresh_zapped_changes_cache()
-        return self._zapped_changes
+        return self._get_status_changes('zap')
 
     def get_undecided_changes(self):
         "returns a list of undecided changes"
-        self._refresh_undecided_changes_cache()
-        return self._undecided_changes
+        return self._get_status_changes('undecided')
+
+    def get_status_count(self, status):
+        "returns the number of changes with a status (use/zap/undecided)"
+        return len(self._get_status_changes(status))
+
+    def get_revision_chain(self, file_path):
+        "returns the EtcProposalRevisionChain of a config file"
+        return self._file_proposals.get(file_path, EMPTY_REVISION_CHAIN)
 
     def get_previous_proposal(self, proposal):
         "returns the previous revision for a config file"
-        revision = proposal.get_revision()
-        previous_proposal = None
-        for p in self.get_file_proposals(proposal.get_file_path()):
-            if p.get_revision() < revision:
-                previous_proposal = p
-        return previous_proposal
+        chain = self.get_revision_chain(proposal.get_file_path())
+        index = bisect.bisect_left(chain.revisions, proposal.get_revision())
+        if index == 0:
+            return None
+        return chain[index - 1]
+
+    def get_later_proposals(self, proposal):
+        "returns the later revisions for a config file"
+        chain = self.get_revision_chain(proposal.get_file_path())
+        return chain[bisect.bisect_right(chain.revisions, proposal.get_revision()):]
+
+    def on_proposal_changed(self, proposal, change = None):
+        "Event, should be fired, if a proposal or one of its changes changes"
+        if not self._status_changes is None:
+            if change is None:
+                [self._update_change_status(c) for c in proposal.get_changes()]
+            else:
+                self._update_change_status(change)
+        if self.get_revision_chain(proposal.get_file_path()).on_proposal_changed(proposal):
+            # the later revisions get diffed again, when their changes are accessed
+            [self._remove_proposal_changes(later_proposal) for later_proposal in self.get_later_proposals(proposal)]
 
-    def on_proposal_changed(self, proposal):
-        "Event, should be fired, if a proposal changes"
-        self.clear_cache()
-        revision = proposal.get_revision()
-        file_path = proposal.get_file_path()
-        [p.clear_cache()
-            for p in self.get_file_proposals(file_path)
-            if p.get_revision() > revision]
+    def _renew_line_pool(self):
+        "drops the cached files of the current pool, the lines stay alive only as long as they are used"
+        FileCache.remove_pool(self.line_pool)
+        self.line_pool = EtcProposalsLinePool()
 
-    def _add_update_proposals(self, dir, current_file_callback):
-        up_regexp = EtcProposal.proposal_regexp()
+    def _add_update_proposals(self, proposal_paths, current_file_callback):
         self.extend((
-            self._create_proposal(os.path.join(path, file), current_file_callback)
-            for (path, dirs, files) in os.walk(dir) for file in files
-            if up_regexp.match(file) ))
+            self._create_proposal(proposal_path, current_file_callback)
+            for proposal_path in proposal_paths ))
 
     def _create_proposal(self, proposal_path, current_file_callback):
         if not current_file_callback is None: current_file_callback(proposal_path)
         return EtcProposal(proposal_path, self)
+
+    def _remove_proposals(self, removed_proposals):
+        "removes proposals from the model, the remaining revisions of their config files are based on the new files"
+        removed_proposals = set(removed_proposals)
+        self[:] = [proposal for proposal in self if not proposal in removed_proposals]
+        for file_path in set([proposal.get_file_path() for proposal in removed_proposals]):
+            remaining_proposals = [proposal for proposal in self.get_file_proposals(file_path) if not proposal in removed_proposals]
+            [proposal.clear_cache() for proposal in remaining_proposals]
+            self._dir_tree.remove_file_proposals(file_path)
+            if remaining_proposals:
+                chain = EtcProposalRevisionChain(remaining_proposals)
+                self._file_proposals[file_path] = chain
+                self._dir_tree.add_file_proposals(file_path, chain)
+            else:
+                del self._file_proposals[file_path]
+        self.clear_cache()
+
+    def _index_proposals(self):
+        "maps the config files to their proposals sorted by revision"
+        file_proposals = dict()
+        for proposal in self:
+            file_proposals.setdefault(proposal.get_file_path(), []).append(proposal)
+        self._file_proposals = dict()
+        self._dir_tree = EtcProposalsDirNode()
+        for (file_path, proposals) in file_proposals.iteritems():
+            chain = EtcProposalRevisionChain(proposals)
+            self._file_proposals[file_path] = chain
+            self._dir_tree.add_file_proposals(file_path, chain)
     
     def _refresh_changes_cache(self):
         if self._changes == None:
+            if Config.DiffWorkers != 1:
+                self._compute_opcodes_parallel()
             self._changes = [change for proposal in self for change in proposal.get_changes()]
-
-    def _refresh_whitespace_changes_cache(self):
+            self._outdated_proposals = list()
+        while self._outdated_proposals:
+            self._insert_proposal_changes(self._outdated_proposals.pop(0))
+
+    def _compute_opcodes_parallel(self):
+        "diffs the proposals of different config files in worker processes"
+        # the base of a revision is the merged content of the previous
+        # revision, so only one revision per config file is diffed at a time
+        chains = [self.get_file_proposals(file_path) for file_path in self.get_files()]
+        pool = None
+        try:
+            for revision_level in range(max([len(chain) for chain in chains] + [0])):
+                pending_proposals = list()
+                for proposal in [chain[revision_level] for chain in chains if len(chain) > revision_level]:
+                    proposal._validate()
+                    if proposal._changes is None and not proposal._init_changes_from_diff_cache():
+                        pending_proposals.append(proposal)
+                if len(pending_proposals) < 2:
+                    [proposal._refresh_changes_cache() for proposal in pending_proposals]
+                    continue
+                if pool is None:
+                    pool = create_diff_pool(Config.DiffWorkers)
+                    if pool is None:
+                        return
+                jobs = [proposal._get_diff_contents() for proposal in pending_proposals]
+                for (proposal, opcodes) in zip(pending_proposals, pool.map(get_opcodes, jobs)):
+                    proposal._init_changes(opcodes)
+        finally:
+            if not pool is None:
+                pool.close()
+                pool.join()
+
+    def _refresh_classified_changes_cache(self):
+        self._refresh_changes_cache()
         if self._whitespace_changes == None:
-            self._whitespace_changes = [change for change in self.get_all_changes() if change.is_whitespace_only()]
-    
-    def _refresh_cvsheader_changes_cache(self):
-        if self._cvsheader_changes == None:
-            self._cvsheader_changes = [change for change in self.get_all_changes() if change.is_cvsheader()]
-
-    def _refresh_unmodified_changes_cache(self):
-        if self._unmodified_changes == None:
-            self._unmodified_changes = [change for change in self.get_all_changes() if change.is_unmodified()]
-
-    def _refresh_used_changes_cache(self):
-        if self._used_changes == None:
-            self._used_changes = [change for change in self.get_all_changes() if change.get_status() == 'use']
-
-    def _refresh_zapped_changes_cache(self):
-        if self._zapped_changes == None:
-            self._zapped_changes = [change for change in self.get_all_changes() if change.get_status() == 'zap']
-
-    def _refresh_undecided_changes_cache(self):
-        if self._undecided_changes == None:
-            self._undecided_changes = [change for change in self.get_all_changes() if change.get_status() == 'undecided']
+            (self._whitespace_changes, self._cvsheader_changes, self._unmodified_changes) = ([], [], [])
+            for change in self.get_all_changes():
+                if change.flags & EtcProposalChange.WHITESPACE:
+                    self._whitespace_changes.append(change)
+                if change.flags & EtcProposalChange.CVSHEADER:
+                    self._cvsheader_changes.append(change)
+                if change.flags & EtcProposalChange.UNMODIFIED:
+                    self._unmodified_changes.append(change)
+
+    def _refresh_status_changes_cache(self):
+        "sorts the changes into a bucket per status, each ordered like all changes by the keys kept next to it"
+        if self._status_changes == None:
+            (self._status_changes, self._status_keys, self._change_statuses) = (dict(), dict(), dict())
+            for status in EtcProposalDecisions.STATUSES:
+                (self._status_changes[status], self._status_keys[status]) = (list(), list())
+            [self._add_status_change(change) for change in self.get_all_changes()]
+
+    def _get_status_changes(self, status):
+        self._refresh_changes_cache()
+        self._refresh_status_changes_cache()
+        return self._status_changes[status]
+
+    def _update_change_status(self, change):
+        "moves a change into the bucket of its current status (outdated changes are in no bucket)"
+        status = self._change_statuses.get(change)
+        if not status is None and status != change.get_status():
+            self._remove_status_change(change)
+            self._add_status_change(change)
+
+    def _add_status_change(self, change):
+        (status, key) = (change.get_status(), change.get_sort_key())
+        index = bisect.bisect(self._status_keys[status], key)
+        self._status_keys[status].insert(index, key)
+        self._status_changes[status].insert(index, change)
+        self._change_statuses[change] = status
+
+    def _remove_status_change(self, change):
+        status = self._change_statuses.pop(change)
+        index = bisect.bisect_left(self._status_keys[status], change.get_sort_key())
+        del self._status_keys[status][index]
+        del self._status_changes[status][index]
+
+    def _remove_proposal_changes(self, proposal):
+        "removes the changes of a revision, whose base changed, from the change lists until they are accessed again"
+        if self._changes is None or proposal in self._outdated_proposals:
+            return
+        self._outdated_proposals.append(proposal)
+        for changes in [self._changes, self._whitespace_changes, self._cvsheader_changes, self._unmodified_changes]:
+            if not changes is None:
+                (start, end) = self._get_proposal_range(changes, proposal)
+                if changes is self._changes and not self._status_changes is None:
+                    [self._remove_status_change(change) for change in changes[start:end]]
+                del changes[start:end]
+
+    def _insert_proposal_changes(self, proposal):
+        "inserts the changes of a new diff of a revision into the change lists"
+        new_changes = proposal.get_changes()
+        index = self._get_proposal_range(self._changes, proposal)[0]
+        self._changes[index:index] = new_changes
+        if not self._whitespace_changes is None:
+            for (changes, flag) in [
+                (self._whitespace_changes, EtcProposalChange.WHITESPACE),
+                (self._cvsheader_changes, EtcProposalChange.CVSHEADER),
+                (self._unmodified_changes, EtcProposalChange.UNMODIFIED)]:
+                index = self._get_proposal_range(changes, proposal)[0]
+                changes[index:index] = [change for change in new_changes if change.flags & flag]
+        if not self._status_changes is None:
+            [self._add_status_change(change) for change in new_changes]
+
+    def _get_proposal_range(self, changes, proposal):
+        "returns the start and the end of the changes of a proposal in a list of changes ordered by their sort keys"
+        return (self._bisect_changes(changes, (proposal.sort_key,)), self._bisect_changes(changes, (proposal.sort_key, sys.maxint)))
+
+    def _bisect_changes(self, changes, key):
+        "returns the index of the first change not ordered before the key"
+        (low, high) = (0, len(changes))
+        while low < high:
+            middle = (low + high) // 2
+            if changes[middle].get_sort_key() < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
 
     @staticmethod
     def scan_all_files():
+        config_protect = PortageInterface.get_config_protect(Config.Backend)
         allpkgparts = PortageInterface.get_fileinfo_from_vdb(
             [os.path.join(path, file)
-            for configbasedir in PortageInterface.get_config_protect(
-                Config.Backend)
+            for configbasedir in config_protect
             for (path, dir, files) in os.walk(configbasedir)
-            for file in files])
+            for file in files], Config.VdbWorkers, config_protect)
+        State.clear_orphaned_configfiles()
         return len([EtcProposalConfigFile(pkgpart.path).update_unmodified(pkgpart.md5) for pkgpart in allpkgparts.values()])
 
 
+class EtcProposalRevisionChain(list):
+    """the proposals for one config file sorted by revision. A revision is
+    based on the merged content of the revision before it, so the merged
+    content of every revision is cached with a version counter, which is
+    increased whenever a decision changes the merged content. A revision is
+    only diffed again, if the version it is based on is outdated."""
+    def __init__(self, file_proposals):
+        list.__init__(self, file_proposals)
+        self.sort(key = lambda proposal: proposal.revision)
+        self.revisions = [proposal.get_revision() for proposal in self]
+        self.merged_contents = [None] * len(self)
+        (self.versions, self.base_versions) = ([0] * len(self), [0] * len(self))
+        self.outdated = [True] * len(self)
+
+    def get_merged_content(self, proposal):
+        "returns the merged content of a revision, merging it only if a decision changed since"
+        index = self._get_index(proposal)
+        self.validate(proposal)
+        if self.outdated[index]:
+            merged_content = proposal.merge()
+            if not self.merged_contents[index] is None and merged_content != self.merged_contents[index]:
+                self.versions[index] += 1
+            (self.merged_contents[index], self.outdated[index]) = (merged_content, False)
+        return self.merged_contents[index]
+
+    def validate(self, proposal):
+        "clears the cache of a revision, if the revision before it merges to a different content now"
+        index = self._get_index(proposal)
+        if index == 0:
+            return
+        self.get_merged_content(self[index - 1])
+        if self.base_versions[index] != self.versions[index - 1]:
+            self.base_versions[index] = self.versions[index - 1]
+            self.outdated[index] = True
+            proposal.clear_cache()
+
+    def invalidate(self, proposal):
+        "clears the cache of a revision, whose files changed"
+        proposal.clear_cache()
+        index = self._get_index(proposal)
+        if index < len(self):
+            self.outdated[index] = True
+
+    def on_proposal_changed(self, proposal):
+        "returns True, if the decisions of a revision changed the base of the later revisions"
+        index = self._get_index(proposal)
+        self.outdated[index] = True
+        if index + 1 == len(self) or self.merged_contents[index] is None:
+            return False
+        version = self.versions[index]
+        self.get_merged_content(proposal)
+        return self.versions[index] != version
+
+    def _get_index(self, proposal):
+        return bisect.bisect_left(self.revisions, proposal.get_revision())
+
+
+EMPTY_REVISION_CHAIN = EtcProposalRevisionChain([])
+
+
+class EtcProposalsDirNode(dict):
+    """a node in the tree of config file paths with proposals. It maps path
+    components to child nodes and counts the files and proposals below it."""
+    def __init__(self):
+        dict.__init__(self)
+        (self.proposals, self.file_count, self.proposal_count) = (list(), 0, 0)
+
+    def add_file_proposals(self, file_path, file_proposals):
+        node = self
+        for part in EtcProposalsDirNode.split_path(file_path):
+            node.file_count += 1
+            node.proposal_count += len(file_proposals)
+            node = node.setdefault(part, EtcProposalsDirNode())
+        node.file_count += 1
+        node.proposal_count += len(file_proposals)
+        node.proposals = file_proposals
+
+    def remove_file_proposals(self, file_path):
+        "removes the proposals of a config file and the nodes, that have no files below them anymore"
+        parts = EtcProposalsDirNode.split_path(file_path)
+        nodes = [self]
+        for part in parts:
+            nodes.append(nodes[-1][part])
+        proposal_count = len(nodes[-1].proposals)
+        for node in nodes:
+            node.file_count -= 1
+            node.proposal_count -= proposal_count
+        nodes[-1].proposals = list()
+        for (parent, part, node) in reversed(zip(nodes[:-1], parts, nodes[1:])):
+            if node.file_count == 0:
+                del parent[part]
+
+    def get_node(self, path):
+        "returns the node for a path or None, if there are no proposals below it"
+        node = self
+        for part in EtcProposalsDirNode.split_path(path):
+            node = node.get(part)
+            if node is None:
+                return None
+        return node
+
+    def get_proposals(self):
+        "returns the proposals for the file of this node and for all files below it"
+        proposals = list(self.proposals)
+        names = self.keys()
+        names.sort()
+        for name in names:
+            proposals.extend(self[name].get_proposals())
+        return proposals
+
+    @staticmethod
+    def split_path(path):
+        return [part for part in os.path.normpath(path).split('/') if part]
+
+
+class EtcProposalsLinePool(object):
+    """keeps one string for every distinct line read from the config files
+    and their proposals. Files in the pool are arrays of line ids, so equal
+    lines in different files or revisions are stored only once. Lines are
+    never removed from a pool, EtcProposals starts a new pool instead, once
+    the pool got too large."""
+    def __init__(self):
+        (self.lines, self.line_ids, self.size) = (list(), dict(), 0)
+
+    def get_line_id(self, line):
+        line_id = self.line_ids.get(line)
+        if line_id is None:
+            line_id = len(self.lines)
+            self.lines.append(line)
+            self.line_ids[line] = line_id
+            self.size += get_string_size(line)
+        return line_id
+
+    def get_size(self):
+        "returns the memory used by the line strings"
+        return self.size
+
+    def intern_lines(self, lines):
+        "returns the lines as PooledLines of this pool"
+        return PooledLines(self, array.array('I', [self.get_line_id(line) for line in lines]))
+
+
+class PooledLines(object):
+    "a list of lines stored as ids of a EtcProposalsLinePool, lines are looked up on access"
+    def __init__(self, pool, ids):
+        (self.pool, self.ids) = (pool, ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return PooledLines(self.pool, self.ids[index])
+        return self.pool.lines[self.ids[index]]
+
+    def __iter__(self):
+        lines = self.pool.lines
+        for line_id in self.ids:
+            yield lines[line_id]
+
+    def __eq__(self, other):
+        if isinstance(other, PooledLines) and other.pool is self.pool:
+            return self.ids == other.ids
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def get_size(self):
+        "returns the memory used by the line ids"
+        return self.ids.itemsize * len(self.ids)
+
+
+def join_lines(parts):
+    "concatenates lists of lines, PooledLines of the same pool are joined by their ids"
+    pools = set([isinstance(part, PooledLines) and part.pool for part in parts])
+    if len(pools) == 1 and not False in pools:
+        ids = array.array('I')
+        [ids.extend(part.ids) for part in parts]
+        return PooledLines(pools.pop(), ids)
+    lines = list()
+    [lines.extend(part) for part in parts]
+    return lines
+
+
+def get_opcodes(contents):
+    "returns the opcodes to turn the first into the second list of lines (or line ids)"
+    (base_lines, proposed_lines) = contents
+    return DiffEngines.get_opcodes(Config.DiffEngine, base_lines, proposed_lines)
+
+
+def create_diff_pool(workers):
+    "returns a pool of worker processes for diffing or None, if multiprocessing is unavailable"
+    if multiprocessing is None:
+        return None
+    if workers < 1:
+        workers = multiprocessing.cpu_count()
+    return multiprocessing.Pool(workers)
+
+
+def create_io_pool(workers):
+    "returns a pool of threads for blocking file operations or None, if multiprocessing is unavailable"
+    if multiprocessing is None or workers == 1:
+        return None
+    if workers < 1:
+        workers = multiprocessing.cpu_count()
+    return multiprocessing.pool.ThreadPool(workers)
+
+
+def fsync_path(path):
+    "syncs a file or directory to disk"
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def create_state(backend, flush_seconds):
+    "returns the state for a backend (shelve/sqlite), sqlite falls back to shelve, if it is unavailable"
+    if backend == 'sqlite' and sqlite3 is None:
+        backend = 'shelve'
+    return {
+        'shelve' : EtcProposalsShelveState,
+        'sqlite' : EtcProposalsSqliteState
+        }[backend](flush_seconds)
+
+
+def get_fingerprint(path):
+    "returns (st_dev, st_ino, st_size, st_mtime) of a file, raises IOError if it cant be stat'ed"
+    try:
+        stat = os.stat(path)
+    except OSError, e:
+        raise IOError(e.errno, e.strerror, path)
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
+
+
+def get_optional_fingerprint(path):
+    "returns the fingerprint of a file or None, if it cant be stat'ed"
+    try:
+        return get_fingerprint(path)
+    except IOError:
+        return None
+
+
+def get_text(lines, start, stop):
+    "returns the lines from start to stop as one string"
+    if isinstance(lines, LineBuffer):
+        return lines.get_text(start, stop)
+    return ''.join(lines[start:stop])
+
+
+def get_string_size(string):
+    "returns the memory used by a string, estimated from its length without sys.getsizeof (python 2.5)"
+    if getsizeof is None:
+        return len(string) + STRING_OVERHEAD
+    return getsizeof(string)
+
+
+def get_md5hexdigest(lines):
+    "returns the md5sum of the lines as they would be written to a file"
+    if isinstance(lines, LineBuffer):
+        return lines.md5hexdigest()
+    return hashlib.md5(''.join(lines)).hexdigest()
+
+
+class LineBuffer(object):
+    """the lines of a memory mapped file. Only the offsets of the lines are
+    kept, the strings are created when lines are accessed. Reading a mapped
+    page beyond the end of a file truncated in place kills the process, so
+    slices, texts and iteration raise an IOError, if the file shrank."""
+    def __init__(self, filepath):
+        self.filepath = filepath
+        fd = open(filepath, 'rb')
+        try:
+            if os.fstat(fd.fileno()).st_size == 0:
+                self.map = ''
+            else:
+                self.map = mmap.mmap(fd.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            fd.close()
+        self.offsets = array.array('L', [0])
+        linestart = 0
+        while linestart < len(self.map):
+            lineend = self.map.find('\n', linestart)
+            if lineend == -1:
+                lineend = len(self.map)
+            else:
+                lineend += 1
+            self.offsets.append(lineend)
+            linestart = lineend
+
+    # pickled for the diff workers by path
+    def __getstate__(self):
+        return self.filepath
+
+    def __setstate__(self, filepath):
+        self.__init__(filepath)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            self._check_size()
+            (start, stop, step) = index.indices(len(self))
+            return [self._get_line(lineno) for lineno in xrange(start, stop, step)]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('line index out of range')
+        return self._get_line(index)
+
+    def __iter__(self):
+        self._check_size()
+        for lineno in xrange(len(self)):
+            yield self._get_line(lineno)
+
+    def get_text(self, start, stop):
+        "returns the lines from start to stop as one string"
+        (start, stop, step) = slice(start, stop).indices(len(self))
+        if start >= stop:
+            return ''
+        self._check_size()
+        return self.map[self.offsets[start]:self.offsets[stop]]
+
+    def get_size(self):
+        "returns the memory used by the line offsets"
+        return self.offsets.itemsize * len(self.offsets)
+
+    def md5hexdigest(self):
+        self._check_size()
+        return hashlib.md5(self.map).hexdigest()
+
+    def _check_size(self):
+        "raises an IOError, if the file is smaller than the mapping now"
+        if len(self.map) > 0 and self.map.size() < len(self.map):
+            raise IOError(errno.EIO, 'file truncated while mapped', self.filepath)
+
+    def _get_line(self, lineno):
+        return self.map[self.offsets[lineno]:self.offsets[lineno + 1]]
+
+
+class EtcProposalFileCacheEntry(object):
+    def __init__(self, filepath, fingerprint, line_pool, lines, size):
+        (self.filepath, self.fingerprint, self.line_pool) = (filepath, fingerprint, line_pool)
+        (self.lines, self.size) = (lines, size)
+        (self.previous, self.next) = (self, self)
+
+    def get_size(self):
+        return self.size
+
+
 class EtcProposalFileCache(object):
-    def __init__(self, max_cached_files):
-        self.max_cached_files = max_cached_files
+    """keeps the lines of the least recently read files up to a total size
+    in bytes. Cached files are checked against their stat data on every
+    access. A file taking more than a quarter of the budget is kept aside,
+    so that it doesnt evict all other files. Files of at least min_mmap_bytes
+    are memory mapped and only their line offsets count against the budget.
+    Files read into a line pool count with the size of their line ids, the
+    line strings are limited by EtcProposals starting a new pool."""
+    def __init__(self, max_cached_bytes, min_mmap_bytes):
+        (self.max_cached_bytes, self.min_mmap_bytes) = (max_cached_bytes, min_mmap_bytes)
+        (self.hits, self.misses, self.evictions) = (0, 0, 0)
         self.clear()
 
-    def readlines_from_file(self, filepath):
-        self._add_cached_file(filepath)
-        return self.cached_content[filepath]
+    def readlines_from_file(self, filepath, line_pool = None):
+        "returns the lines of a file, as PooledLines if a line pool is given"
+        fingerprint = get_fingerprint(filepath)
+        entry = self._get_entry(filepath)
+        if not entry is None:
+            if entry.fingerprint == fingerprint and entry.line_pool is line_pool:
+                self.hits += 1
+                if not entry is self.large_entry:
+                    self._unlink(entry)
+                    self._link_newest(entry)
+                return entry.lines
+            self._remove(entry)
+        self.misses += 1
+        if self.min_mmap_bytes > 0 and fingerprint[2] >= self.min_mmap_bytes:
+            lines = LineBuffer(filepath)
+            entry = EtcProposalFileCacheEntry(filepath, fingerprint, line_pool, lines, lines.get_size())
+        elif line_pool is None:
+            entry = EtcProposalFileCacheEntry(filepath, fingerprint, None, open(filepath).readlines(), fingerprint[2])
+        else:
+            lines = line_pool.intern_lines(open(filepath).readlines())
+            entry = EtcProposalFileCacheEntry(filepath, fingerprint, line_pool, lines, lines.get_size())
+        self._add(entry)
+        return entry.lines
 
-    def _add_cached_file(self, filepath):
-        if filepath in self.last_files:
-            self.last_files.remove(filepath)
-        self.last_files.append(filepath)
-        if len(self.last_files) > self.max_cached_files:
-            del self.cached_content[self.last_files.pop(0)]
-        if filepath not in self.cached_content:
-            self.cached_content[filepath] = open(filepath).readlines()
+    def remove_pool(self, line_pool):
+        "removes the files read into a line pool"
+        for entry in self.entries.values() + [self.large_entry]:
+            if not entry is None and entry.line_pool is line_pool:
+                self._remove(entry)
 
     def clear(self):
-        self.last_files = list()
-        self.cached_content = dict()
-        
+        self.entries = dict()
+        self.oldest = EtcProposalFileCacheEntry(None, None, None, None, 0)
+        (self.cached_bytes, self.large_entry) = (0, None)
+
+    def _get_entry(self, filepath):
+        if not self.large_entry is None and self.large_entry.filepath == filepath:
+            return self.large_entry
+        return self.entries.get(filepath)
+
+    def _add(self, entry):
+        if entry.get_size() * 4 > self.max_cached_bytes:
+            if not self.large_entry is None:
+                self.evictions += 1
+            self.large_entry = entry
+            return
+        self.entries[entry.filepath] = entry
+        self._link_newest(entry)
+        self.cached_bytes += entry.get_size()
+        while self.cached_bytes > self.max_cached_bytes:
+            self._remove(self.oldest.next)
+            self.evictions += 1
+
+    def _remove(self, entry):
+        if entry is self.large_entry:
+            self.large_entry = None
+            return
+        del self.entries[entry.filepath]
+        self._unlink(entry)
+        self.cached_bytes -= entry.get_size()
+
+    # the entries form a ring with self.oldest as sentinel
+    def _link_newest(self, entry):
+        (entry.previous, entry.next) = (self.oldest.previous, self.oldest)
+        self.oldest.previous.next = entry
+        self.oldest.previous = entry
+
+    def _unlink(self, entry):
+        entry.previous.next = entry.next
+        entry.next.previous = entry.previous
+        (entry.previous, entry.next) = (entry, entry)
+
 
 class EtcProposalsConfig(object):
     def __init__(self):
@@ -539,11 +1354,28 @@ class EtcProposalsConfig(object):
         self.__prefered_frontends = self.get_optional_value('General', 'PreferedFrontends', '').split(',')
         self.__backend = self.get_optional_value('General', 'Backend', 'portage')
         self.__fastexit = self.get_optional_value('General', 'Fastexit', 'False').lower() == 'true'
-        self.__max_cached_files = self.get_optional_value('General', 'MaxCachedFiles', 10)
-        self.__max_changes_per_proposal = self.get_optional_value('General', 'MaxChangesPerProposal', 100)
+        self.__max_cached_bytes = int(self.get_optional_value('General', 'MaxCachedKiloBytes', 8192)) * 1024
+        self.__min_mmap_bytes = int(self.get_optional_value('General', 'MinMmapKiloBytes', 0)) * 1024
+        self.__state_flush_seconds = int(self.get_optional_value('General', 'StateFlushSeconds', 5))
+        self.__state_backend = self.get_optional_value('General', 'StateBackend', 'shelve')
+        self.__max_changes_per_proposal = int(self.get_optional_value('General', 'MaxChangesPerProposal', 100))
+        self.__diff_workers = int(self.get_optional_value('General', 'DiffWorkers', 1))
+        self.__apply_workers = int(self.get_optional_value('General', 'ApplyWorkers', 0))
+        self.__vdb_workers = int(self.get_optional_value('General', 'VdbWorkers', 0))
+        self.__scan_workers = int(self.get_optional_value('General', 'ScanWorkers', 0))
+        self.__scan_prune_globs = [prune_glob.strip()
+            for prune_glob in self.get_optional_value('General', 'ScanPruneGlobs', '').split(',')
+            if prune_glob.strip()]
+        self.__scan_max_depth = int(self.get_optional_value('General', 'ScanMaxDepth', 0))
+        self.__diff_engine = self.get_optional_value('General', 'DiffEngine', 'difflib')
+        self.__diff_cache_max_age = int(self.get_optional_value('General', 'DiffCacheMaxAge', 30))
+        self.__diff_cache_max_bytes = int(self.get_optional_value('General', 'DiffCacheMaxKiloBytes', 4096)) * 1024
+        self.__persist_fingerprints = self.get_optional_value('General', 'PersistFingerprints', 'False').lower() == 'true'
 
     def __set_fastexit(self, value): self.__fastexit = value
     def __set_prefered_frontends(self, value): self.__prefered_frontends = value
+    def __set_diff_workers(self, value): self.__diff_workers = value
+    def __set_diff_engine(self, value): self.__diff_engine = value
 
     def get_optional_value(self, section, option, default):
         try:
@@ -558,38 +1390,581 @@ class EtcProposalsConfig(object):
     Fastexit = property(lambda self: self.__fastexit, __set_fastexit)
 
     Backend = property(lambda self: self.__backend)
-    MaxCachedFiles = property(lambda self: self.__max_cached_files)
+    MaxCachedBytes = property(lambda self: self.__max_cached_bytes)
+    MinMmapBytes = property(lambda self: self.__min_mmap_bytes)
+    StateFlushSeconds = property(lambda self: self.__state_flush_seconds)
+    StateBackend = property(lambda self: self.__state_backend)
     MaxChangesPerProposal = property(lambda self: self.__max_changes_per_proposal)
-
-class EtcProposalsState(shelve.Shelf):
-    def __init__(self):
-        shelve.Shelf.__init__(self, anydbm.open(STATEFILE, 'c'))
+    DiffWorkers = property(lambda self: self.__diff_workers, __set_diff_workers)
+    ApplyWorkers = property(lambda self: self.__apply_workers)
+    VdbWorkers = property(lambda self: self.__vdb_workers)
+    ScanWorkers = property(lambda self: self.__scan_workers)
+    ScanPruneGlobs = property(lambda self: self.__scan_prune_globs)
+    ScanMaxDepth = property(lambda self: self.__scan_max_depth)
+    DiffEngine = property(lambda self: self.__diff_engine, __set_diff_engine)
+    DiffCacheMaxAge = property(lambda self: self.__diff_cache_max_age)
+    DiffCacheMaxBytes = property(lambda self: self.__diff_cache_max_bytes)
+    PersistFingerprints = property(lambda self: self.__persist_fingerprints)
+
+class EtcProposalsState(object):
+    """the persistent state. The decisions on proposals, the md5s of
+    unmodified config files and the fingerprints each have a table of their
+    own. Keys are routed to their table by the namespace before '://', the
+    decisions table is keyed by the whole key, the others by path.
+    Decisions and fingerprints are written behind: defer() only remembers
+    how to get the value of a key and flush() writes all pending keys in one
+    batch per table and syncs once. Pending keys are flushed at the latest after flush_seconds,
+    before applying and at exit. Backends implement _get_value, _set_values,
+    _del_value, _has_value, _get_paths and _sync for the namespaces."""
+    NAMESPACES = [None, 'EtcProposalConfigFile', 'EtcProposalFingerprint']
+
+    def __init__(self, flush_seconds):
+        (self.flush_seconds, self.pending, self.last_flush) = (flush_seconds, dict(), time.time())
+        self.unsynced = False
+
+    def __getitem__(self, key):
+        if self.pending.has_key(key):
+            return self.pending[key]()
+        (namespace, path) = self._split_key(key)
+        return self._get_value(namespace, path)
+
+    def __setitem__(self, key, value):
+        (namespace, path) = self._split_key(key)
+        self.pending.pop(key, None)
+        self._set_values(namespace, [(path, value)])
+        self.unsynced = True
+
+    def __delitem__(self, key):
+        (namespace, path) = self._split_key(key)
+        if self.pending.has_key(key):
+            del self.pending[key]
+            if not self._has_value(namespace, path):
+                return
+        self._del_value(namespace, path)
+        self.unsynced = True
+
+    def has_key(self, key):
+        (namespace, path) = self._split_key(key)
+        return self.pending.has_key(key) or self._has_value(namespace, path)
+
+    __contains__ = has_key
+
+    def keys(self):
+        keys = set(self.pending.keys())
+        for namespace in self.NAMESPACES:
+            keys.update(self._get_keys(namespace))
+        return list(keys)
+
+    def defer(self, key, get_value):
+        "sets the key to the result of get_value() on the next flush"
+        self.pending[key] = get_value
+        if time.time() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        "writes all pending keys and syncs the state"
+        if self.pending:
+            (pending, self.pending) = (self.pending, dict())
+            namespace_items = dict()
+            for (key, get_value) in pending.iteritems():
+                (namespace, path) = self._split_key(key)
+                namespace_items.setdefault(namespace, []).append((path, get_value()))
+            for (namespace, items) in namespace_items.iteritems():
+                self._set_values(namespace, items)
+            self.unsynced = True
+        if self.unsynced:
+            self._sync()
+            self.unsynced = False
+        self.last_flush = time.time()
     
     def get_configfiles(self):
-        return (key for key in self.keys() if key.startswith('EtcProposalConfigFile:'))
+        return self._get_keys('EtcProposalConfigFile')
 
     def get_proposals(self):
-        return (key for key in self.keys() if key.startswith('EtcProposal:'))
+        "returns the keys of the decisions table and the pending decisions"
+        return set(self._get_paths(None)).union(
+            [key for key in self.pending.iterkeys() if self._split_key(key)[0] is None])
+
+    def get_fingerprints(self):
+        return self._get_keys('EtcProposalFingerprint')
 
     def clear_orphaned(self, current_proposals):
         self.clear_orphaned_configfiles()
+        self.clear_orphaned_fingerprints()
         self.clear_orphaned_proposals(current_proposals)
     
     def clear_orphaned_proposals(self, current_proposals):
-        stateproposalsfiles = set(self.get_proposals())
-        fsproposalsfiles = set(current_proposals)
-        for proposal in (stateproposalsfiles-fsproposalsfiles):
+        stateproposals = self.get_proposals()
+        fsproposals = set((proposal._get_state_url() for proposal in current_proposals))
+        for proposal in (stateproposals - fsproposals):
             del self[proposal]
     
     def clear_orphaned_configfiles(self):
-        for stateconfigfile in self.get_configfiles():
-            if not os.path.exists(stateconfigfile.replace('EtcProposalConfigFile://','',1)):
-                del self[stateconfigfile]
+        self._clear_orphaned_paths('EtcProposalConfigFile')
+
+    def clear_orphaned_fingerprints(self):
+        self._clear_orphaned_paths('EtcProposalFingerprint')
     
     def clear_all(self):
+        self.pending.clear()
         for key in self.keys():
             del self[key]
-        
+
+    def _get_keys(self, namespace):
+        if namespace is None:
+            return list(self._get_paths(None))
+        return [namespace + '://' + path for path in self._get_paths(namespace)]
+
+    def _split_key(self, key):
+        "returns the namespace of the key and the path in its table or (None, key) for decisions"
+        (namespace, separator, path) = key.partition('://')
+        if namespace in self.NAMESPACES:
+            return (namespace, path)
+        return (None, key)
+
+    def _clear_orphaned_paths(self, namespace):
+        "removes the paths, that do not exist anymore, listing every directory only once"
+        dir_paths = dict()
+        for path in self._get_paths(namespace):
+            dir_paths.setdefault(os.path.dirname(path), []).append(path)
+        for (dir, paths) in dir_paths.iteritems():
+            try:
+                filenames = set(os.listdir(dir))
+            except OSError:
+                filenames = set()
+            for path in paths:
+                if not os.path.basename(path) in filenames:
+                    self._del_value(namespace, path)
+                    self.unsynced = True
+
+
+class EtcProposalsShelveState(EtcProposalsState):
+    "keeps the state in one dbm file per table"
+    TABLEFILES = {
+        None : STATEFILE,
+        'EtcProposalConfigFile' : CONFIGFILESTATEFILE,
+        'EtcProposalFingerprint' : FINGERPRINTSTATEFILE }
+
+    def __init__(self, flush_seconds):
+        EtcProposalsState.__init__(self, flush_seconds)
+        self.tables = dict([(namespace, shelve.Shelf(anydbm.open(tablefile, 'c')))
+            for (namespace, tablefile) in self.TABLEFILES.iteritems()])
+        self._move_keys_to_tables()
+
+    def _get_value(self, namespace, path):
+        return self.tables[namespace][path]
+
+    def _set_values(self, namespace, items):
+        table = self.tables[namespace]
+        for (path, value) in items:
+            table[path] = value
+
+    def _del_value(self, namespace, path):
+        del self.tables[namespace][path]
+
+    def _has_value(self, namespace, path):
+        return self.tables[namespace].has_key(path)
+
+    def _get_paths(self, namespace):
+        return self.tables[namespace].keys()
+
+    def _sync(self):
+        for table in self.tables.itervalues():
+            table.sync()
+
+    def _move_keys_to_tables(self):
+        "moves keys from state files, that had all namespaces in one table"
+        decisions = self.tables[None]
+        for key in decisions.keys():
+            (namespace, path) = self._split_key(key)
+            if not namespace is None:
+                self.tables[namespace][path] = decisions[key]
+                del decisions[key]
+
+
+class EtcProposalsSqliteState(EtcProposalsState):
+    """keeps the state in a SQLite database in WAL mode, so readers do not
+    block the writer. Writes are committed by flush(). A state file of the
+    shelve backend is migrated once, when the database is created."""
+    SCHEMA_VERSION = 1
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS decisions (key TEXT PRIMARY KEY, changes BLOB);
+        CREATE TABLE IF NOT EXISTS configfiles (path TEXT PRIMARY KEY, dir TEXT, md5 TEXT);
+        CREATE INDEX IF NOT EXISTS configfiles_dir ON configfiles (dir);
+        CREATE TABLE IF NOT EXISTS fingerprints (path TEXT PRIMARY KEY, dir TEXT,
+            dev INTEGER, ino INTEGER, size INTEGER, mtime REAL, md5 TEXT);
+        CREATE INDEX IF NOT EXISTS fingerprints_dir ON fingerprints (dir);
+        """
+    # (table, key column, value columns)
+    TABLES = {
+        None : ('decisions', 'key', ['changes']),
+        'EtcProposalConfigFile' : ('configfiles', 'path', ['dir', 'md5']),
+        'EtcProposalFingerprint' : ('fingerprints', 'path', ['dir', 'dev', 'ino', 'size', 'mtime', 'md5']) }
+
+    def __init__(self, flush_seconds):
+        EtcProposalsState.__init__(self, flush_seconds)
+        self.connection = sqlite3.connect(SQLITESTATEFILE, timeout = 30)
+        self.connection.text_factory = str
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.executescript(self.SCHEMA)
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] < self.SCHEMA_VERSION:
+            self._migrate_shelve_state()
+            self.connection.execute('PRAGMA user_version = %d' % self.SCHEMA_VERSION)
+            self.connection.commit()
+
+    def _get_value(self, namespace, path):
+        (table, keycolumn, columns) = self.TABLES[namespace]
+        row = self.connection.execute('SELECT %s FROM %s WHERE %s = ?' % (', '.join(columns), table, keycolumn), (path,)).fetchone()
+        if row is None:
+            raise KeyError(path)
+        return {
+            None : lambda row: cPickle.loads(str(row[0])),
+            'EtcProposalConfigFile' : lambda row: row[1],
+            'EtcProposalFingerprint' : lambda row: (tuple(row[1:5]), row[5])
+            }[namespace](row)
+
+    def _set_values(self, namespace, items):
+        (table, keycolumn, columns) = self.TABLES[namespace]
+        encode = {
+            None : lambda path, value: (path, sqlite3.Binary(cPickle.dumps(value, 2))),
+            'EtcProposalConfigFile' : lambda path, value: (path, os.path.dirname(path), value),
+            'EtcProposalFingerprint' : lambda path, value: (path, os.path.dirname(path)) + tuple(value[0]) + (value[1],)
+            }[namespace]
+        self.connection.executemany('INSERT OR REPLACE INTO %s (%s, %s) VALUES (%s)' % (
+            table, keycolumn, ', '.join(columns), ', '.join(['?'] * (len(columns) + 1))),
+            (encode(path, value) for (path, value) in items))
+
+    def _del_value(self, namespace, path):
+        (table, keycolumn, columns) = self.TABLES[namespace]
+        self.connection.execute('DELETE FROM %s WHERE %s = ?' % (table, keycolumn), (path,))
+
+    def _has_value(self, namespace, path):
+        (table, keycolumn, columns) = self.TABLES[namespace]
+        return not self.connection.execute('SELECT 1 FROM %s WHERE %s = ?' % (table, keycolumn), (path,)).fetchone() is None
+
+    def _get_paths(self, namespace):
+        (table, keycolumn, columns) = self.TABLES[namespace]
+        return [row[0] for row in self.connection.execute('SELECT %s FROM %s' % (keycolumn, table))]
+
+    def _sync(self):
+        self.connection.commit()
+
+    def _migrate_shelve_state(self):
+        if not whichdb.whichdb(STATEFILE):
+            return
+        shelve_state = EtcProposalsShelveState(self.flush_seconds)
+        for namespace in self.NAMESPACES:
+            self._set_values(namespace, [(path, shelve_state._get_value(namespace, path))
+                for path in shelve_state._get_paths(namespace)])
+
+
+class EtcProposalsApplyJournal(object):
+    """writes merged config files in two phases. The merged files are written
+    to temporary files next to the config files and synced together, then the
+    journal is committed and the temporary files are renamed over the config
+    files. recover() rolls an interrupted apply back, if the journal was not
+    committed yet, and forward otherwise."""
+    TEMPSUFFIX = '.merged'
+
+    def __init__(self, journalpath, workers):
+        (self.journalpath, self.workers) = (journalpath, workers)
+
+    def apply(self, file_merges, current_file_callback = None):
+        "writes (file path, merged chunks, proposal paths) tuples and removes the proposals"
+        if not file_merges:
+            return
+        entries = [(file_path, file_path + self.TEMPSUFFIX, proposal_paths)
+            for (file_path, chunks, proposal_paths) in file_merges]
+        self._write_journal('prepare', entries)
+        for ((file_path, chunks, proposal_paths), temp_path) in zip(file_merges, [entry[1] for entry in entries]):
+            if not current_file_callback is None: current_file_callback(file_path)
+            fd = open(temp_path, 'w')
+            try:
+                fd.writelines(chunks)
+            finally:
+                fd.close()
+            try:
+                shutil.copymode(file_path, temp_path)
+                shutil.copystat(file_path, temp_path)
+            except OSError:
+                pass
+        self._sync_paths([temp_path for (file_path, temp_path, proposal_paths) in entries])
+        self._write_journal('commit', entries)
+        self._commit(entries)
+
+    def recover(self):
+        "finishes or rolls back an interrupted apply"
+        try:
+            fd = open(self.journalpath, 'rb')
+        except IOError:
+            return
+        try:
+            (phase, entries) = cPickle.load(fd)
+        finally:
+            fd.close()
+        if phase == 'commit':
+            self._commit(entries)
+            return
+        for (file_path, temp_path, proposal_paths) in entries:
+            self._unlink(temp_path)
+        self._unlink(self.journalpath)
+
+    def _commit(self, entries):
+        for (file_path, temp_path, proposal_paths) in entries:
+            if os.path.exists(temp_path):
+                os.rename(temp_path, file_path)
+            [self._unlink(proposal_path) for proposal_path in proposal_paths]
+        self._sync_paths(list(set([os.path.dirname(file_path) for (file_path, temp_path, proposal_paths) in entries])))
+        self._unlink(self.journalpath)
+
+    def _write_journal(self, phase, entries):
+        fd = open(self.journalpath + '.new', 'wb')
+        try:
+            cPickle.dump((phase, entries), fd, 2)
+            fd.flush()
+            os.fsync(fd.fileno())
+        finally:
+            fd.close()
+        os.rename(self.journalpath + '.new', self.journalpath)
+        fsync_path(os.path.dirname(self.journalpath))
+
+    def _sync_paths(self, paths):
+        pool = create_io_pool(self.workers)
+        if pool is None:
+            [fsync_path(path) for path in paths]
+            return
+        try:
+            pool.map(fsync_path, paths)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+class EtcProposalsScanner(object):
+    """finds the proposals below the CONFIG_PROTECT dirs. The stat of every
+    directory is cached together with its subdirectories and proposals, so
+    directories, that did not change since the last scan, are only stat'ed
+    instead of listed. Independent dirs are scanned in parallel threads.
+    Subtrees in CONFIG_PROTECT_MASK, matching one of the prune globs or
+    deeper than max_depth (0 is unlimited) are not descended into."""
+    RACY_SECONDS = 2
+
+    def __init__(self, cachepath, workers, prune_globs = [], max_depth = 0):
+        (self.cachepath, self.workers) = (cachepath, workers)
+        (self.prune_globs, self.max_depth) = (prune_globs, max_depth)
+        (self.cache, self.masks, self.listed_dirs) = (dict(), set(), 0)
+
+    def scan(self, roots, masks = []):
+        "returns a list of the proposal paths for every root"
+        self.cache = self._load_cache()
+        self.masks = set([os.path.normpath(mask) for mask in masks if mask])
+        (self.scanned, self.listed_dirs) = (dict(), 0)
+        pool = None
+        if len(roots) > 1:
+            pool = create_io_pool(self.workers)
+        if pool is None:
+            proposal_paths = [self._scan_root(root) for root in roots]
+        else:
+            try:
+                proposal_paths = pool.map(self._scan_root, roots)
+            finally:
+                pool.close()
+                pool.join()
+        if self.scanned != self.cache:
+            self._save_cache(self.scanned)
+        self.cache = self.scanned
+        return proposal_paths
+
+    def is_pruned(self, dir, depth):
+        "returns True, if the scan should not descend into dir"
+        if self.max_depth > 0 and depth > self.max_depth:
+            return True
+        if dir in self.masks:
+            return True
+        for prune_glob in self.prune_globs:
+            if fnmatch.fnmatch(dir, prune_glob):
+                return True
+        return False
+
+    def _scan_root(self, root):
+        if not root or os.path.normpath(root) in self.masks:
+            return []
+        up_regexp = EtcProposal.proposal_regexp()
+        (proposal_paths, dirs) = (list(), [(root, 0)])
+        while dirs:
+            (dir, depth) = dirs.pop()
+            try:
+                dirstat = os.stat(dir)
+            except OSError:
+                continue
+            stamp = (dirstat.st_dev, dirstat.st_ino, dirstat.st_mtime)
+            entry = self.cache.get(dir)
+            if entry is None or entry[0] != stamp:
+                entry = (stamp,) + self._list_dir(dir)
+            if time.time() - dirstat.st_mtime > self.RACY_SECONDS:
+                self.scanned[dir] = entry
+            (stamp, subdirs, proposals) = entry
+            proposal_paths.extend([os.path.join(dir, name) for name in proposals
+                if not os.path.join(dir, up_regexp.match(name).group(1)) in self.masks])
+            dirs.extend([(os.path.join(dir, name), depth + 1) for name in subdirs
+                if not self.is_pruned(os.path.join(dir, name), depth + 1)])
+        return proposal_paths
+
+    def _list_dir(self, dir):
+        "returns the subdirectories (not following symlinks) and the proposals of a dir"
+        self.listed_dirs += 1
+        up_regexp = EtcProposal.proposal_regexp()
+        try:
+            if scandir is None:
+                entries = [(name, os.path.isdir(os.path.join(dir, name))) for name in os.listdir(dir)]
+                entries = [(name, is_dir, is_dir and os.path.islink(os.path.join(dir, name)))
+                    for (name, is_dir) in entries]
+            else:
+                entries = [(entry.name, entry.is_dir(), entry.is_symlink()) for entry in scandir(dir)]
+        except OSError:
+            return ([], [])
+        subdirs = [name for (name, is_dir, is_link) in entries if is_dir and not is_link]
+        proposals = [name for (name, is_dir, is_link) in entries if not is_dir and up_regexp.match(name)]
+        return (subdirs, proposals)
+
+    def _load_cache(self):
+        try:
+            fd = open(self.cachepath, 'rb')
+        except IOError:
+            return dict()
+        try:
+            try:
+                return cPickle.load(fd)
+            except Exception:
+                return dict()
+        finally:
+            fd.close()
+
+    def _save_cache(self, cache):
+        try:
+            fd = open(self.cachepath + '.new', 'wb')
+            try:
+                cPickle.dump(cache, fd, 2)
+            finally:
+                fd.close()
+            os.rename(self.cachepath + '.new', self.cachepath)
+        except (IOError, OSError):
+            pass
+
+
+class EtcProposalsDiffCache(object):
+    """remembers opcodes and content flags of changes across sessions. The
+    entries are keyed by the diff settings and the md5s of both contents.
+    When each entry was used last and how many bytes it takes are kept in a
+    small index next to the entries, so entries are only unpickled when
+    they are looked up. Entries not used for max_age and the least recently
+    used ones above max_bytes are removed when the cache is opened and when
+    it outgrows max_bytes. The index is written by flush()."""
+    SECONDS_PER_DAY = 24 * 60 * 60
+    INDEXSUFFIX = '.index'
+
+    def __init__(self, cachepath, max_age, max_bytes):
+        (self.cachepath, self.max_age, self.max_bytes) = (cachepath, max_age * self.SECONDS_PER_DAY, max_bytes)
+        self.db = anydbm.open(cachepath, 'c')
+        # entries written after the index was saved the last time are dropped
+        keys = set(self.db.keys())
+        self.index = dict([(key, entry) for (key, entry) in self._load_index().iteritems() if key in keys])
+        for key in keys.difference(self.index):
+            del self.db[key]
+        self.cached_bytes = sum([size for (last_used, size) in self.index.itervalues()])
+        self.unsaved = False
+        self.clear_stale()
+
+    def __len__(self):
+        return len(self.index)
+
+    def has_key(self, key):
+        return self.index.has_key(key)
+
+    def get_key(self, base_lines, proposed_lines):
+        return '%s/%d:%s:%s' % (
+            Config.DiffEngine,
+            Config.MaxChangesPerProposal,
+            get_md5hexdigest(base_lines),
+            get_md5hexdigest(proposed_lines))
+
+    def lookup(self, key):
+        "returns (opcodes, content_flags) or None, if the diff isnt cached"
+        if not self.index.has_key(key):
+            return None
+        try:
+            (opcodes, content_flags) = cPickle.loads(self.db[key])
+        except Exception:
+            self._remove(key)
+            return None
+        self.index[key] = (time.time(), self.index[key][1])
+        self.unsaved = True
+        return (opcodes, content_flags)
+
+    def store(self, key, opcodes, content_flags):
+        value = cPickle.dumps((opcodes, content_flags), 2)
+        if self.index.has_key(key):
+            self.cached_bytes -= self.index[key][1]
+        self.db[key] = value
+        self.index[key] = (time.time(), len(value))
+        self.cached_bytes += len(value)
+        self.unsaved = True
+        if self.cached_bytes > self.max_bytes:
+            self.clear_stale()
+
+    def clear_stale(self):
+        "removes entries not used for max_age and the least recently used ones above max_bytes"
+        entries = [(last_used, key) for (key, (last_used, size)) in self.index.iteritems()]
+        entries.sort(reverse = True)
+        (expired, kept_bytes) = (time.time() - self.max_age, 0)
+        for (last_used, key) in entries:
+            kept_bytes += self.index[key][1]
+            if last_used < expired or kept_bytes > self.max_bytes:
+                self._remove(key)
+
+    def flush(self):
+        "syncs the entries and writes the index"
+        if not self.unsaved:
+            return
+        if hasattr(self.db, 'sync'):
+            self.db.sync()
+        try:
+            fd = open(self.cachepath + self.INDEXSUFFIX + '.new', 'wb')
+            try:
+                cPickle.dump(self.index, fd, 2)
+            finally:
+                fd.close()
+            os.rename(self.cachepath + self.INDEXSUFFIX + '.new', self.cachepath + self.INDEXSUFFIX)
+        except (IOError, OSError):
+            return
+        self.unsaved = False
+
+    def _remove(self, key):
+        self.cached_bytes -= self.index.pop(key)[1]
+        if self.db.has_key(key):
+            del self.db[key]
+        self.unsaved = True
+
+    def _load_index(self):
+        try:
+            fd = open(self.cachepath + self.INDEXSUFFIX, 'rb')
+        except IOError:
+            return dict()
+        try:
+            try:
+                return cPickle.load(fd)
+            except Exception:
+                return dict()
+        finally:
+            fd.close()
+
 
 __all__ = ['EtcProposalChange', 'EtcProposal', 'EtcProposals', 'Config', 'FrontendFailedException']
 
@@ -600,5 +1975,11 @@ if __name__ == '__main__':
 # Singletons
 
 Config = EtcProposalsConfig()
-FileCache = EtcProposalFileCache(Config.MaxCachedFiles)
-State = EtcProposalsState()
+FileCache = EtcProposalFileCache(Config.MaxCachedBytes, Config.MinMmapBytes)
+FingerprintCache = EtcProposalFingerprintCache(Config.PersistFingerprints)
+State = create_state(Config.StateBackend, Config.StateFlushSeconds)
+atexit.register(State.flush)
+DiffCache = EtcProposalsDiffCache(DIFFCACHEFILE, Config.DiffCacheMaxAge, Config.DiffCacheMaxBytes)
+atexit.register(DiffCache.flush)
+ApplyJournal = EtcProposalsApplyJournal(JOURNALFILE, Config.ApplyWorkers)
+Scanner = EtcProposalsScanner(SCANCACHEFILE, Config.ScanWorkers, Config.ScanPruneGlobs, Config.ScanMaxDepth)
@@ -72,9 +72,7 @@ class EtcProposalsQt4Decorator(EtcProposals):
         self.get_whitespace_changes()
         self.get_cvsheader_changes()
         self.get_unmodified_changes()
-        self.get_used_changes()
-        self.get_zapped_changes()
-        self.get_undecided_changes()
+        self.get_status_count('undecided')
 
 
 class ChangeLabel(qt.QFrame):
@@ -325,13 +323,15 @@ class EtcProposalsTreeView(qt.QFrame):
     def refresh(self):
         self.fsnode.takeChildren()
         for file in self.proposals.get_files():
-            parent = self.fsnode
+            (parent, path) = (self.fsnode, '/')
             for part in file[1:].split('/'):
+                path = os.path.join(path, part)
                 items = [parent.child(i) for i in xrange(0, parent.childCount()) if parent.child(i).text(0) == part]
                 if len(items) == 1:
                     parent = items[0]
                 else:
                     parent = qt.QTreeWidgetItem(parent, [part])
+                    parent.setToolTip(0, '%d proposals' % self.proposals.get_dir_proposal_count(path))
         self.treeview.expandAll()
 
     def get_changegenerator_for_node(self, nodes):
@@ -622,16 +622,23 @@ class EtcProposalsController(object):
         [change.undo() for change in changes]
         self.proposals.warmup_cache()
         self.view.paned.changesview.update_changes()
+        self.schedule_state_flush()
 
     def zap_changes(self, changes):
         [change.zap() for change in changes]
         self.proposals.warmup_cache()
         self.view.paned.changesview.update_changes()
+        self.schedule_state_flush()
 
     def use_changes(self, changes):
         [change.use() for change in changes]
         self.proposals.warmup_cache()
         self.view.paned.changesview.update_changes()
+        self.schedule_state_flush()
+
+    def schedule_state_flush(self):
+        "writes the decisions to the state file, when Qt is idle"
+        qt.QTimer.singleShot(0, self.proposals.flush_state)
 
     def apply(self):
         self.proposals.apply()
@@ -56,6 +56,8 @@ class CmdLineColorizer(object):
 
 
 class EtcProposalChangeShellDecorator(EtcProposalChange):
+    __slots__ = ()
+
     def get_status_description(self, colorizer):
         if not self.touched:
             return '---'
@@ -105,6 +107,8 @@ class EtcProposalChangeShellDecorator(EtcProposalChange):
 
 
 class EtcProposalShellDecorator(EtcProposal):
+    __slots__ = ()
+
     def get_status_description(self):
         self._assure_changes_exists()
         return {True : '(finished)', False : '(        )'}[self.is_finished()]
@@ -150,13 +154,13 @@ class EtcProposalsShellConfig(object):
             else:
                 editor = os.environ['EDITOR']
             if editor.count('nano') > 0:
-                self.__edit_command = '%s +%%(linenumber)d,0 "%%(filename)s"' % os.environ['EDITOR']
+                self.__edit_command = '%s +%%(linenumber)d,0 "%%(filename)s"' % editor
             elif editor.count('vi') > 0:
-                self.__edit_command = '%s -c %%(linenumber)d "%%(filename)s"' % os.environ['EDITOR']
+                self.__edit_command = '%s -c %%(linenumber)d "%%(filename)s"' % editor
             elif editor.count('emacs') > 0:
-                self.__edit_command = '%s +%%(linenumber)d "%%(filename)s"' % os.environ['EDITOR']
+                self.__edit_command = '%s +%%(linenumber)d "%%(filename)s"' % editor
             else:
-                self.__edit_command = '%s "%%(filename)s"' % os.environ['EDITOR']
+                self.__edit_command = '%s "%%(filename)s"' % editor
 
     Colorize = property(lambda self: self.__colorize)
     StartupCommands = property(lambda self: self.__startup_commands)
@@ -190,6 +194,10 @@ class EtcProposalsCmdLine(cmd.Cmd):
             self.onecmd(command)
         self.intro = ''
 
+    def postcmd(self, stop, line):
+        self.proposals.flush_state()
+        return stop
+
     def help_quickstart(self):
         """etc-proposals Quickstart
 
@@ -4,41 +4,204 @@
 # based on gentoo portage 2.1.1, Copyright 1998-2007 Gentoo Foundation
 # Distributed under the terms of the GNU General Public License v2
 
-import re, string, os
+import re, string, os, cPickle, itertools
 from etcproposals.etcproposals_tools import get_command_output_iterator
 
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
 # portage constants
 
 VDB_PATH = "/var/db/pkg"
+COUNTER_PATH = "/var/cache/edb/counter"
+VDB_INDEX_PATH = "/var/state/etcproposals.vdbindex"
+# parsing less packages in worker processes isnt worth starting them
+MIN_PARALLEL_PKGS = 64
+MAKE_GLOBALS_PATHS = ["/usr/share/portage/config/make.globals", "/etc/make.globals"]
+MAKE_PROFILE_PATHS = ["/etc/make.profile", "/etc/portage/make.profile"]
+USER_PROFILE_PATH = "/etc/portage/profile"
+MAKE_CONF_PATHS = ["/etc/make.conf", "/etc/portage/make.conf"]
+ENV_D_PATH = "/etc/env.d"
 
 
 class NotImplementedError(Exception):
     pass
 
+# portage config stuff
+class PortageConfig(object):
+    """calculates CONFIG_PROTECT and CONFIG_PROTECT_MASK from make.globals,
+    the profile stack, make.conf, env.d and the environment like portage does,
+    without starting it. The result is cached until one of the files read
+    changes."""
+    INCREMENTALS = ['CONFIG_PROTECT', 'CONFIG_PROTECT_MASK']
+    ASSIGNMENT = re.compile(r'^[ \t]*(?:export[ \t]+)?([A-Za-z_][A-Za-z0-9_]*)='
+        r'(?:"((?:[^"\\]|\\.)*)"|\'([^\']*)\'|([^\s#]*))', re.M)
+    VARIABLE = re.compile(r'\$\{([A-Za-z_][A-Za-z0-9_]*)\}|\$([A-Za-z_][A-Za-z0-9_]*)')
+    cached = (None, None)
+
+    @staticmethod
+    def get_config_protect_and_mask():
+        "returns CONFIG_PROTECT and CONFIG_PROTECT_MASK or None, if the portage config was not found"
+        (stamps, result) = PortageConfig.cached
+        environment = [os.environ.get(var) for var in PortageConfig.INCREMENTALS]
+        if stamps is not None and stamps == PortageConfig._get_stamps([path for (path, stamp) in stamps[1:]], environment):
+            return result
+        make_globals = [path for path in MAKE_GLOBALS_PATHS if os.path.isfile(path)][:1]
+        profiles = PortageConfig._get_profile_stack()
+        if not make_globals or not profiles:
+            return None
+        env_d_files = PortageConfig._get_env_d_files()
+        layers = [PortageConfig._read_config(path) for path in env_d_files + make_globals]
+        layers.extend([PortageConfig._read_config(os.path.join(profile, 'make.defaults')) for profile in profiles])
+        layers.extend([PortageConfig._read_config(path) for path in MAKE_CONF_PATHS])
+        layers.append(os.environ)
+        result = tuple([PortageConfig._stack_incremental([layer.get(var, '').split() for layer in layers])
+            for var in PortageConfig.INCREMENTALS])
+        paths = [ENV_D_PATH] + env_d_files + make_globals + MAKE_PROFILE_PATHS + [USER_PROFILE_PATH] + MAKE_CONF_PATHS + \
+            [os.path.join(profile, name) for profile in profiles for name in ['parent', 'make.defaults']]
+        PortageConfig.cached = (PortageConfig._get_stamps(paths, environment), result)
+        return result
+
+    @staticmethod
+    def _get_stamps(paths, environment):
+        stamps = [environment]
+        for path in paths:
+            try:
+                path_stat = os.stat(path)
+                stamps.append((path, (path_stat.st_ino, path_stat.st_mtime)))
+            except OSError:
+                stamps.append((path, None))
+        return stamps
+
+    @staticmethod
+    def _get_profile_stack():
+        "returns the profile dirs, parents first"
+        profiles = [os.path.realpath(path) for path in MAKE_PROFILE_PATHS if os.path.isdir(path)][:1]
+        if not profiles:
+            return []
+        stack = list()
+        PortageConfig._add_profile(profiles[0], stack)
+        if os.path.isdir(USER_PROFILE_PATH):
+            stack.append(USER_PROFILE_PATH)
+        return stack
+
+    @staticmethod
+    def _add_profile(profile, stack):
+        try:
+            fd = open(os.path.join(profile, 'parent'))
+            try:
+                parents = [line.strip() for line in fd if line.strip() and not line.strip().startswith('#')]
+            finally:
+                fd.close()
+        except IOError:
+            parents = []
+        for parent in parents:
+            parent = os.path.realpath(os.path.join(profile, parent))
+            if not parent in stack:
+                PortageConfig._add_profile(parent, stack)
+        stack.append(profile)
+
+    @staticmethod
+    def _get_env_d_files():
+        "returns the env.d files env-update reads"
+        try:
+            names = sorted(os.listdir(ENV_D_PATH))
+        except OSError:
+            return []
+        return [os.path.join(ENV_D_PATH, name) for name in names
+            if len(name) > 2 and name[:2].isdigit() and not name.endswith('~') and not name.endswith('.bak')
+            and os.path.isfile(os.path.join(ENV_D_PATH, name))]
+
+    @staticmethod
+    def _read_config(path):
+        "returns the variables assigned in a shell style config file"
+        config = dict()
+        try:
+            fd = open(path)
+            try:
+                content = fd.read()
+            finally:
+                fd.close()
+        except IOError:
+            return config
+        for match in PortageConfig.ASSIGNMENT.finditer(content):
+            (name, doublequoted, singlequoted, unquoted) = match.groups()
+            if singlequoted is not None:
+                config[name] = singlequoted
+                continue
+            value = doublequoted
+            if value is None:
+                value = unquoted
+            value = value.replace('\\\n', ' ').replace('\\"', '"')
+            config[name] = PortageConfig.VARIABLE.sub(
+                lambda variable: config.get(variable.group(1) or variable.group(2), ''), value)
+        return config
+
+    @staticmethod
+    def _stack_incremental(layers):
+        "stacks the tokens of an incremental variable, '-token' removes a token, '-*' all of them"
+        tokens = list()
+        for layer in layers:
+            for token in layer:
+                if token == '-*':
+                    tokens = list()
+                elif token.startswith('-'):
+                    if token[1:] in tokens:
+                        tokens.remove(token[1:])
+                elif not token in tokens:
+                    tokens.append(token)
+        return tokens
+
+
 # portage utils stuff
 class PortageUtils(object):
     @staticmethod
     def get_config_protect():
+        return PortageUtils.get_config_protect_and_mask()[0]
+
+    @staticmethod
+    def get_config_protect_and_mask():
+        result = PortageConfig.get_config_protect_and_mask()
+        if result is not None:
+            return result
+        config_vars = dict()
         for line in get_command_output_iterator(['emerge', '--info']):
-            match = re.match(r'CONFIG_PROTECT="(.*)"', line)
-            if match:
-                return match.group(1).split(' ')
-        return []
+            match = re.match(r'(CONFIG_PROTECT(?:_MASK)?)="(.*)"', line)
+            if match and not config_vars.has_key(match.group(1)):
+                config_vars[match.group(1)] = match.group(2).split()
+        return (config_vars.get('CONFIG_PROTECT', []), config_vars.get('CONFIG_PROTECT_MASK', []))
 
 
 # pkgcore utils stuff
 class PkgcoreUtils(object):
     @staticmethod
     def get_config_protect():
+        return PkgcoreUtils.get_config_protect_and_mask()[0]
+
+    @staticmethod
+    def get_config_protect_and_mask():
+        result = PortageConfig.get_config_protect_and_mask()
+        if result is not None:
+            return result
+        config_vars = dict()
         for line in get_command_output_iterator(['pconfig', 'dump-uncollapsed']):
-            match = re.match(r"'CONFIG_PROTECT' = '(.*)'", line)
-            if match:
-                return match.group(1).split(' ')
-        return []
+            match = re.match(r"'(CONFIG_PROTECT(?:_MASK)?)' = '(.*)'", line)
+            if match and not config_vars.has_key(match.group(1)):
+                config_vars[match.group(1)] = match.group(2).split()
+        return (config_vars.get('CONFIG_PROTECT', []), config_vars.get('CONFIG_PROTECT_MASK', []))
 
 
 # Installed package DB stuff
 class PortagePkgPart(object):
+    __slots__ = ['category', 'package', 'version', 'parttype']
+
     def __init__(self, category, package, version, parttype):
         (self.category, self.package, self.version, self.parttype) = (category, package, version, parttype)
 
@@ -51,18 +214,40 @@ class PortagePkgPart(object):
 
 
 class PortagePkgPartObject(PortagePkgPart):
+    __slots__ = ['type', 'path', 'md5', 'mtime']
+
     def __init__(self, dbcontentsline, category, package, version):
         PortagePkgPart.__init__(self, category, package, version, 'obj')
         templine = dbcontentsline.split(' ', 1)
         self.type = templine[0]
         (self.path, self.md5, mtimestring) = templine[1].rsplit(' ', 2)     
         self.mtime = int(mtimestring)
+
+    @staticmethod
+    def create(path, md5, mtime, category, package, version):
+        "creates a part from fileinfo already parsed"
+        pkgpart = PortagePkgPartObject.__new__(PortagePkgPartObject)
+        PortagePkgPart.__init__(pkgpart, category, package, version, 'obj')
+        (pkgpart.type, pkgpart.path, pkgpart.md5, pkgpart.mtime) = ('obj', path, md5, mtime)
+        return pkgpart
     
 
 class InstalledPkg(object):
+    "a handle of an installed package, its vdb files are only read when asked for"
     def __init__(self, dbpath):
         self.dbpath = dbpath
 
+    def pf(self):
+        "returns the package name with version and revision"
+        try:
+            fd = open(os.path.join(self.dbpath, 'PF'))
+            try:
+                return fd.read().strip()
+            finally:
+                fd.close()
+        except IOError:
+            return os.path.basename(self.dbpath)
+
     def contents(self):
         result = list()
         fd = open(os.path.join(self.dbpath, 'CONTENTS'))
@@ -75,15 +260,215 @@ class InstalledPkg(object):
         fd.close()
         return result
 
+    def fileinfo(self, paths = None):
+        "returns (path, md5, mtime) for the objs in CONTENTS, only for the given paths if any"
+        result = list()
+        try:
+            fd = open(os.path.join(self.dbpath, 'CONTENTS'))
+        except IOError:
+            return result
+        try:
+            for line in fd:
+                if not line.startswith('obj '):
+                    continue
+                (path, md5, mtimestring) = line[4:].replace('\n', '').rsplit(' ', 2)
+                if paths is None or path in paths:
+                    result.append((path, md5, int(mtimestring)))
+        finally:
+            fd.close()
+        return result
+
+    def counter(self):
+        "returns the COUNTER of the merge or 0, if it is unknown"
+        return read_counter(os.path.join(self.dbpath, 'COUNTER'))
+
     
 class InstalledPkgDB(object):
     def __init__(self, dbpath = VDB_PATH):
         self.dbpath = dbpath
 
+    def installed_pkgs(self):
+        "returns a generator of handles for the installed packages"
+        for category in list_subdirs(self.dbpath):
+            categorypath = os.path.join(self.dbpath, category)
+            for package in list_subdirs(categorypath):
+                if not package.startswith('-MERGING-'):
+                    yield InstalledPkg(os.path.join(categorypath, package))
+
     def installed_pkgs_dbpaths(self):
-        return  (path
-            for (path, dirs, files) in os.walk(self.dbpath) for file in files
-            if file == 'PF')
+        return (pkg.dbpath for pkg in self.installed_pkgs())
+
+    def changed_since(self, counter, global_counter_path = COUNTER_PATH):
+        """returns the packages merged after the given COUNTER. Unmerged
+        packages are not detected, as unmerging does not increase COUNTER."""
+        if os.path.exists(global_counter_path) and read_counter(global_counter_path) <= counter:
+            return []
+        return [pkg for pkg in self.installed_pkgs() if pkg.counter() > counter]
+
+
+def read_counter(path):
+    "returns the number in a COUNTER file or 0, if it is unknown"
+    try:
+        fd = open(path)
+        try:
+            return int(fd.read().strip() or 0)
+        finally:
+            fd.close()
+    except (IOError, ValueError):
+        return 0
+
+
+def list_subdirs(path):
+    "returns the names of the subdirectories of a dir, skipping hidden ones"
+    try:
+        if scandir is None:
+            return [name for name in os.listdir(path)
+                if not name.startswith('.') and os.path.isdir(os.path.join(path, name))]
+        return [entry.name for entry in scandir(path)
+            if not entry.name.startswith('.') and entry.is_dir()]
+    except OSError:
+        return []
+
+
+def read_pkg_contents(pkgdbpath, paths = None):
+    "returns (pkgdbpath, counter, fileinfo) of an installed package"
+    pkg = InstalledPkg(pkgdbpath)
+    return (pkgdbpath, pkg.counter(), pkg.fileinfo(paths))
+
+
+def read_pkgs_contents_shard(shard):
+    (pkgdbpaths, paths) = shard
+    return [read_pkg_contents(pkgdbpath, paths) for pkgdbpath in pkgdbpaths]
+
+
+def read_pkgs_contents(pkgdbpaths, paths = None, workers = 1):
+    """returns (pkgdbpath, counter, fileinfo) for installed packages. Many
+    packages are spread across worker processes (0 uses one per cpu)."""
+    if multiprocessing is None or workers == 1 or len(pkgdbpaths) < MIN_PARALLEL_PKGS:
+        return (read_pkg_contents(pkgdbpath, paths) for pkgdbpath in pkgdbpaths)
+    if workers < 1:
+        workers = multiprocessing.cpu_count()
+    shard_count = workers * 4
+    pool = multiprocessing.Pool(workers)
+    try:
+        shards = pool.map(read_pkgs_contents_shard,
+            [(pkgdbpaths[shard_index::shard_count], paths) for shard_index in xrange(shard_count)])
+    finally:
+        pool.close()
+        pool.join()
+    return itertools.chain(*shards)
+
+
+class ProtectedPaths(object):
+    "contains the paths below the CONFIG_PROTECT dirs"
+    def __init__(self, protect_dirs):
+        self.prefixes = tuple([os.path.join(os.path.normpath(dir), '') for dir in protect_dirs if dir])
+
+    def __contains__(self, path):
+        return path.startswith(self.prefixes)
+
+
+class InstalledPkgIndex(object):
+    """a persistent index from the paths of installed files below the
+    CONFIG_PROTECT dirs to their vdb entries. The index is only updated if
+    the global COUNTER or the mtime of the vdb changed since it was written
+    (portage changes both when merging and the mtime when unmerging), then
+    only packages added or merged again are parsed. The index is written to
+    a temporary file, that is renamed over it. If a path belongs to several
+    packages, the one merged last (with the highest COUNTER) wins."""
+    def __init__(self, protect_dirs, indexpath = VDB_INDEX_PATH, dbpath = VDB_PATH, workers = 1, counter_path = COUNTER_PATH):
+        (self.protect_dirs, self.indexpath, self.dbpath) = (sorted(protect_dirs), indexpath, dbpath)
+        (self.workers, self.counter_path) = (workers, counter_path)
+
+    def get_fileinfo(self, files):
+        "returns a dict containing the fileinfo that were recorded in the vdb for the given files"
+        protected_paths = ProtectedPaths(self.protect_dirs)
+        index = self._get_index()
+        pkgparts = dict()
+        for path in set(files):
+            if index['paths'].has_key(path):
+                (counter, md5, mtime, pkgdbpath) = max(index['paths'][path])
+                pkgparts[path] = PortagePkgPartObject.create(path, md5, mtime,
+                    os.path.basename(os.path.dirname(pkgdbpath)), os.path.basename(pkgdbpath), '')
+        unprotected_files = [path for path in set(files) if not path in protected_paths]
+        if unprotected_files:
+            pkgparts.update(PortageInterface.scan_vdb(unprotected_files, self.workers))
+        return pkgparts
+
+    def _get_index(self):
+        "returns the index, updating it if the vdb changed"
+        index = self._load_index()
+        stamp = self._get_stamp()
+        if index['stamp'] == stamp and index['protect_dirs'] == self.protect_dirs:
+            return index
+        if index['protect_dirs'] != self.protect_dirs:
+            index = self._create_index()
+        pkgdb = InstalledPkgDB(self.dbpath)
+        pkgdbpaths = set(pkgdb.installed_pkgs_dbpaths())
+        changed = set([pkg.dbpath for pkg in pkgdb.changed_since(index['counter'], self.counter_path)])
+        changed.update([pkgdbpath for pkgdbpath in pkgdbpaths if not index['packages'].has_key(pkgdbpath)])
+        removed = [pkgdbpath for pkgdbpath in index['packages'] if not pkgdbpath in pkgdbpaths]
+        for pkgdbpath in list(changed) + removed:
+            self._remove_package(index, pkgdbpath)
+        for (pkgdbpath, counter, fileinfo) in read_pkgs_contents(list(changed), ProtectedPaths(self.protect_dirs), self.workers):
+            self._add_package(index, pkgdbpath, counter, fileinfo)
+        (index['stamp'], index['protect_dirs']) = (stamp, self.protect_dirs)
+        index['counter'] = max([index['counter']] + [counter for (counter, paths) in index['packages'].itervalues()])
+        self._save_index(index)
+        return index
+
+    def _get_stamp(self):
+        "returns the global COUNTER and the mtime of the vdb, taken before reading the vdb"
+        try:
+            mtime = os.stat(self.dbpath).st_mtime
+        except OSError:
+            mtime = None
+        return (read_counter(self.counter_path), mtime)
+
+    def _create_index(self):
+        return {'stamp' : None, 'protect_dirs' : None, 'counter' : 0, 'packages' : dict(), 'paths' : dict()}
+
+    def _load_index(self):
+        try:
+            fd = open(self.indexpath, 'rb')
+        except IOError:
+            return self._create_index()
+        try:
+            try:
+                return cPickle.load(fd)
+            except Exception:
+                return self._create_index()
+        finally:
+            fd.close()
+
+    def _save_index(self, index):
+        "writes the index to a temporary file and renames it, so an interrupted write leaves the old index"
+        try:
+            fd = open(self.indexpath + '.new', 'wb')
+            try:
+                cPickle.dump(index, fd, 2)
+                fd.flush()
+                os.fsync(fd.fileno())
+            finally:
+                fd.close()
+            os.rename(self.indexpath + '.new', self.indexpath)
+        except (IOError, OSError):
+            pass
+
+    def _remove_package(self, index, pkgdbpath):
+        if not index['packages'].has_key(pkgdbpath):
+            return
+        for path in index['packages'].pop(pkgdbpath)[1]:
+            path_entries = [entry for entry in index['paths'][path] if entry[3] != pkgdbpath]
+            if path_entries:
+                index['paths'][path] = path_entries
+            else:
+                del index['paths'][path]
+
+    def _add_package(self, index, pkgdbpath, counter, fileinfo):
+        for (path, md5, mtime) in fileinfo:
+            index['paths'].setdefault(path, []).append((counter, md5, mtime, pkgdbpath))
+        index['packages'][pkgdbpath] = (counter, [path for (path, md5, mtime) in fileinfo])
 
 
 class PortageInterface(object):
@@ -95,26 +480,42 @@ class PortageInterface(object):
             }[backend]()
 
     @staticmethod
-    def get_fileinfo_from_vdb(files):
-        "returns a dict containing the fileinfo that were recorded in the vdb for the given files"
+    def get_config_protect_and_mask(backend):
+        "returns CONFIG_PROTECT and CONFIG_PROTECT_MASK"
+        return {
+            'portage' : PortageUtils.get_config_protect_and_mask,
+            'pkgcore' : PkgcoreUtils.get_config_protect_and_mask
+            }[backend]()
+
+    @staticmethod
+    def get_fileinfo_from_vdb(files, workers = 1, protect_dirs = None):
+        """returns a dict containing the fileinfo that were recorded in the vdb for the given files,
+        the files below the CONFIG_PROTECT dirs are looked up in an index, if the dirs are given"""
+        if protect_dirs is None:
+            return PortageInterface.scan_vdb(files, workers)
+        return InstalledPkgIndex(protect_dirs, workers = workers).get_fileinfo(files)
+
+    @staticmethod
+    def scan_vdb(files, workers = 1):
+        "like get_fileinfo_from_vdb, but parses the vdb instead of using the index"
         files_to_check = set(files)
+        found = dict()
+        pkgdbpaths = list(InstalledPkgDB().installed_pkgs_dbpaths())
+        for (pkgdbpath, counter, fileinfo) in read_pkgs_contents(pkgdbpaths, files_to_check, workers):
+            for (path, md5, mtime) in fileinfo:
+                found[path] = max(found.get(path), (counter, md5, mtime, pkgdbpath))
         pkgparts = dict()
-        allpkgcontents = (pkgpart for pkgdbpath in InstalledPkgDB().installed_pkgs_dbpaths()
-            for pkgpart in InstalledPkg(pkgdbpath).contents())
-        for pkgpart in allpkgcontents:
-            if pkgpart.path in files_to_check:
-                pkgparts[pkgpart.path] = pkgpart
-                files_to_check.discard(pkgpart.path)
-            if len(files_to_check) == 0:
-                break   
+        for (path, (counter, md5, mtime, pkgdbpath)) in found.iteritems():
+            pkgparts[path] = PortagePkgPartObject.create(path, md5, mtime,
+                os.path.basename(os.path.dirname(pkgdbpath)), os.path.basename(pkgdbpath), '')
         return pkgparts
 
     # deprecated
     @staticmethod
-    def get_md5_from_vdb(files):
+    def get_md5_from_vdb(files, workers = 1, protect_dirs = None):
         "returns a dict containing the md5s that were recorded in the vdb for the given files"
         md5s = {}
-        for pkgpart in PortageInterface.get_fileinfo_from_vdb(files).values():
+        for pkgpart in PortageInterface.get_fileinfo_from_vdb(files, workers, protect_dirs).values():
             md5s[pkgpart.path] = pkgpart.md5
         return md5s
 
@@ -2,9 +2,11 @@
 import unittest
 import portage_stubs_test
 import etcproposals_lib_test
+import etcproposals_diff_test
+import etcproposals_readline_test
 import etcproposals_gtk_test
 
-alltests = [portage_stubs_test.alltestssuite, etcproposals_lib_test.alltestssuite, etcproposals_gtk_test.alltestssuite]
+alltests = [portage_stubs_test.alltestssuite, etcproposals_lib_test.alltestssuite, etcproposals_diff_test.alltestssuite, etcproposals_readline_test.alltestssuite, etcproposals_gtk_test.alltestssuite]
 alltestssuite = unittest.TestSuite(alltests)
 
 if __name__ == '__main__':
@@ -0,0 +1,44 @@
+#! /usr/bin/python
+# compares the diff engines on the update proposals found in the given
+# directories (defaults to CONFIG_PROTECT)
+import os, os.path, re, sys, time
+from etcproposals.etcproposals_diff import DiffEngines
+from etcproposals.portage_stubs import PortageInterface
+
+ENGINES = ['difflib', 'myers']
+
+def get_proposal_corpus(dirs):
+    proposal_regexp = re.compile('^\._cfg[0-9]{4}_(.*)')
+    corpus = list()
+    for dir in dirs:
+        for (path, dirs, files) in os.walk(dir):
+            for file in files:
+                match = proposal_regexp.match(file)
+                if not match:
+                    continue
+                try:
+                    base_lines = open(os.path.join(path, match.group(1))).readlines()
+                except IOError:
+                    base_lines = []
+                corpus.append((base_lines, open(os.path.join(path, file)).readlines()))
+    return corpus
+
+def benchmark(engine, corpus, rounds):
+    (hunks, equal_lines) = (0, 0)
+    starttime = time.time()
+    for round in range(rounds):
+        for (base_lines, proposed_lines) in corpus:
+            opcodes = DiffEngines.get_opcodes(engine, base_lines, proposed_lines)
+            if round == 0:
+                hunks += len([opcode for opcode in opcodes if opcode[0] != 'equal'])
+                equal_lines += sum([opcode[2] - opcode[1] for opcode in opcodes if opcode[0] == 'equal'])
+    return ((time.time() - starttime) / rounds, hunks, equal_lines)
+
+if __name__ == '__main__':
+    dirs = sys.argv[1:] or PortageInterface.get_config_protect('portage')
+    corpus = get_proposal_corpus(dirs)
+    lines = sum([len(base_lines) + len(proposed_lines) for (base_lines, proposed_lines) in corpus])
+    print '%d proposals with %d lines' % (len(corpus), lines)
+    for engine in ENGINES:
+        (seconds, hunks, equal_lines) = benchmark(engine, corpus, 3)
+        print '%s%8.3fs %6d changes %8d unchanged lines' % (engine.ljust(10), seconds, hunks, equal_lines)
@@ -0,0 +1,65 @@
+#! /usr/bin/python
+import unittest
+from etcproposals.etcproposals_diff import DiffEngines, DifflibEngine, MyersEngine
+
+BASELINES = ['#  Header: dkljdfskjjkd\n', '1\n', '2\n', '3 testtesttest\n', '4 testtesttest\n',
+    '5\n', '6\n', '7\n', '8\n', '9\n', '10\n', '11\n', '12\n', '\n', '\n', '\n', '13\n']
+PROPOSEDLINES = ['#  Header: fdskjkljfsdkjdsfkkj\n', '1\n', '2\n', '3 testte---sttest\n', '4 testtesttest\n',
+    '5\n', '7\n', '8\n', '9\n', '9a\n', '10\n', '11\n', '12\n', '\n', '13\n']
+
+
+class TestDiffEngine(unittest.TestCase):
+    def _apply_opcodes(self, opcodes, base_lines, proposed_lines):
+        result = list()
+        for (tag, i1, i2, j1, j2) in opcodes:
+            if tag == 'equal':
+                self.failUnless(base_lines[i1:i2] == proposed_lines[j1:j2], 'Equal opcode covers different lines.')
+            result.extend(proposed_lines[j1:j2])
+        return result
+
+    def _check_engine(self, engine):
+        for (base_lines, proposed_lines) in [(BASELINES, PROPOSEDLINES), ([], PROPOSEDLINES), (BASELINES, []), (BASELINES, BASELINES)]:
+            opcodes = DiffEngines.get_opcodes(engine, base_lines, proposed_lines)
+            self.failUnless(self._apply_opcodes(opcodes, base_lines, proposed_lines) == proposed_lines, 'Opcodes dont reproduce the proposal.')
+
+
+class TestDifflibEngine(TestDiffEngine):
+    def runTest(self):
+        """Testing the difflib diff engine"""
+        self._check_engine('difflib')
+
+
+class TestMyersEngine(TestDiffEngine):
+    def runTest(self):
+        """Testing the myers diff engine"""
+        self._check_engine('myers')
+        self.failUnless(
+            self._count_equal_lines('myers') >= self._count_equal_lines('difflib'),
+            'myers found less unchanged lines than difflib.')
+
+    def _count_equal_lines(self, engine):
+        return sum([i2 - i1 for (tag, i1, i2, j1, j2) in DiffEngines.get_opcodes(engine, BASELINES, PROPOSEDLINES) if tag == 'equal'])
+
+
+class TestMyersFallback(TestDiffEngine):
+    def runTest(self):
+        """Testing if the myers diff engine falls back to difflib on expensive diffs"""
+        max_cost = MyersEngine.max_cost
+        try:
+            MyersEngine.max_cost = 0
+            self.failUnless(MyersEngine.get_opcodes(BASELINES, PROPOSEDLINES) == DifflibEngine.get_opcodes(BASELINES, PROPOSEDLINES),
+                'myers did not fall back to difflib.')
+            self._check_engine('myers')
+        finally:
+            MyersEngine.max_cost = max_cost
+        base_lines = ['%d\n' % line for line in range(2000)]
+        proposed_lines = [line.replace('0', 'o') for line in base_lines]
+        opcodes = DiffEngines.get_opcodes('myers', base_lines, proposed_lines)
+        self.failUnless(self._apply_opcodes(opcodes, base_lines, proposed_lines) == proposed_lines, 'Opcodes dont reproduce the rewritten file.')
+
+
+alltests = [TestDifflibEngine(), TestMyersEngine(), TestMyersFallback()]
+alltestssuite = unittest.TestSuite(alltests)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -60,8 +60,12 @@ class EtcProposalsStub(list):
         return [EtcProposalChangeStub(True), EtcProposalChangeStub(False)]
     def get_dir_changes_gen(self, dir):
         return [EtcProposalChangeStub(True), EtcProposalChangeStub(False)]
+    def get_dir_proposal_count(self, dir):
+        return 1
     def refresh(self, callback):
         pass
+    def flush_state(self):
+        pass
     
 
 class EtcProposalsControllerStub(object):
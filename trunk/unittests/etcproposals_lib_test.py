@@ -4,9 +4,11 @@ from etcproposals import etcproposals_lib
 from etcproposals.portage_stubs import PortageInterface
 import os.path
 import os
+import shelve, shutil, tempfile, time
 
 TESTCONFIGFILENAME = '/etc/etcproposalsTESTCONFIG'
 TESTCONFIGPROPOSALFILENAME = '/etc/._cfg0000_etcproposalsTESTCONFIG'
+TESTCONFIGLATERPROPOSALFILENAME = '/etc/._cfg0001_etcproposalsTESTCONFIG'
 
 BASECONTENT = """#  Header: dkljdfskjjkd      
 1
@@ -66,7 +68,7 @@ class TestEtcProposalsLib(unittest.TestCase):
         return open(filename).read() == content
 
     def _clear_testfiles(self):
-        for testfile in [TESTCONFIGPROPOSALFILENAME, TESTCONFIGFILENAME]:
+        for testfile in [TESTCONFIGLATERPROPOSALFILENAME, TESTCONFIGPROPOSALFILENAME, TESTCONFIGFILENAME]:
             try:
                 os.unlink(testfile)
             except OSError:
@@ -105,6 +107,47 @@ class TestUndoAll(TestEtcProposalsLib):
         self.failUnless(self._has_filecontent(TESTCONFIGFILENAME, BASECONTENT), 'Filecontent changed.')
         self.failUnless(os.path.exists(TESTCONFIGPROPOSALFILENAME), 'Proposal was removed.')
 
+class TestStatusBuckets(TestEtcProposalsLib):
+    def runTest(self):
+        """Testing if changes move between the status buckets on use, zap and undo"""
+        open(TESTCONFIGLATERPROPOSALFILENAME, 'w').write(MODCONTENT + '\n14')
+        proposals = etcproposals_lib.EtcProposals()
+        for change in proposals.get_all_changes():
+            change.undo()
+        (first_proposal, later_proposal) = proposals.get_file_proposals(TESTCONFIGFILENAME)
+        first_changes = first_proposal.get_changes()
+        self._check_buckets(proposals, {'use' : 0, 'zap' : 0})
+        status_changes = proposals._status_changes
+        first_changes[1].zap()
+        first_changes[3].use()
+        first_changes[2].use()
+        self._check_buckets(proposals, {'use' : 2, 'zap' : 1})
+        self.failUnless(proposals.get_used_changes() == [first_changes[2], first_changes[3]], 'Used changes out of order.')
+        first_changes[2].undo()
+        first_changes[1].use()
+        self.failUnless(proposals.get_used_changes() == [first_changes[1], first_changes[3]], 'Used changes out of order.')
+        self._check_buckets(proposals, {'use' : 2, 'zap' : 0})
+        self.failUnless(proposals._status_changes is status_changes, 'Status buckets were rebuilt.')
+        # the later revision is diffed again, because its base changed
+        later_changes = later_proposal.get_changes()
+        [change.zap() for change in later_changes]
+        first_changes[0].use()
+        self.failIf([change for change in later_changes if change in proposals.get_zapped_changes()], 'Outdated changes still in a bucket.')
+        self.failUnless(proposals.get_all_changes()[-len(later_proposal.get_changes()):] == later_proposal.get_changes(), 'Changes of the new diff not listed.')
+        self._check_buckets(proposals, {'use' : 3})
+        self.failUnless(proposals._status_changes is status_changes, 'Status buckets were rebuilt after a new diff.')
+        # the decisions would be restored by later tests on the same contents
+        for change in proposals.get_all_changes():
+            change.undo()
+
+    def _check_buckets(self, proposals, status_counts):
+        "checks the buckets against all changes and the counts of the given statuses"
+        all_changes = proposals.get_all_changes()
+        for status in ['use', 'zap', 'undecided']:
+            status_changes = [change for change in all_changes if change.get_status() == status]
+            self.failUnless(proposals._get_status_changes(status) == status_changes, 'Wrong changes in the %s bucket.' % status)
+            self.failUnless(proposals.get_status_count(status) == status_counts.get(status, len(status_changes)), 'Wrong number of %s changes.' % status)
+
 class TestWhitespaceonly(TestEtcProposalsLib):
     def runTest(self):
         """Testing if whitespace recognition works"""
@@ -119,13 +162,493 @@ class TestCVSHeader(TestEtcProposalsLib):
         cvsheaderchanges = [change for change in proposals.get_all_changes() if change.is_cvsheader()]
         self.failUnless(len(cvsheaderchanges) == 1, 'CVS-Header recognition failed.')
 
+class TestParallelDiff(TestEtcProposalsLib):
+    def runTest(self):
+        """Testing if diffing in worker processes yields the same changes"""
+        serial_opcodes = [change.opcode for change in etcproposals_lib.EtcProposals().get_all_changes()]
+        etcproposals_lib.Config.DiffWorkers = 2
+        try:
+            parallel_opcodes = [change.opcode for change in etcproposals_lib.EtcProposals().get_all_changes()]
+        finally:
+            etcproposals_lib.Config.DiffWorkers = 1
+        self.failUnless(serial_opcodes == parallel_opcodes, 'Parallel diffing changed the changes.')
+
+class TestDirChanges(TestEtcProposalsLib):
+    def runTest(self):
+        """Testing if changes are found by directory"""
+        proposals = etcproposals_lib.EtcProposals()
+        self.failUnless(len(proposals.get_dir_changes('/etc')) == len(proposals.get_all_changes()), 'Changes in /etc not found.')
+        self.failUnless(len(proposals.get_dir_changes(TESTCONFIGFILENAME[:-6])) == 0, 'Found changes for a file with a similar name.')
+        self.failUnless(proposals.get_dir_proposal_count('/etc') == 1, 'Proposal count of /etc is wrong.')
+
+class TestLineBuffer(TestEtcProposalsLib):
+    def runTest(self):
+        """Testing if a memory mapped file yields the same lines as reading it"""
+        lines = open(TESTCONFIGPROPOSALFILENAME).readlines()
+        linebuffer = etcproposals_lib.LineBuffer(TESTCONFIGPROPOSALFILENAME)
+        self.failUnless(list(linebuffer) == lines, 'Memory mapped lines differ.')
+        self.failUnless(linebuffer[2:5] == lines[2:5] and linebuffer[-1] == lines[-1], 'Indexing memory mapped lines failed.')
+        self.failUnless(linebuffer.get_text(2, 5) == ''.join(lines[2:5]), 'Memory mapped text differs.')
+
+class TestLineBufferTruncation(TestEtcProposalsLib):
+    def runTest(self):
+        """Testing if reading a memory mapped file truncated in place fails without crashing"""
+        open(TESTCONFIGPROPOSALFILENAME, 'w').write(MODCONTENT * 1000)
+        linebuffer = etcproposals_lib.LineBuffer(TESTCONFIGPROPOSALFILENAME)
+        fd = open(TESTCONFIGPROPOSALFILENAME, 'r+')
+        fd.truncate(10)
+        fd.close()
+        self.failUnlessRaises(IOError, linebuffer.get_text, 0, len(linebuffer))
+        self.failUnlessRaises(IOError, list, linebuffer)
+
+class TestFileCacheFiles(unittest.TestCase):
+    "reads files of 100 bytes into a file cache of 400 bytes"
+    def setUp(self):
+        self.filedir = tempfile.mkdtemp()
+        self.file_cache = etcproposals_lib.EtcProposalFileCache(400, 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.filedir)
+
+    def _write_file(self, name, lines = 10, char = 'x'):
+        open(os.path.join(self.filedir, name), 'w').write((char * 9 + '\n') * lines)
+
+    def _read_file(self, name):
+        return self.file_cache.readlines_from_file(os.path.join(self.filedir, name))
+
+    def _get_cached_names(self):
+        return sorted([os.path.basename(filepath) for filepath in self.file_cache.entries.keys()])
+
+class TestFileCacheLRU(TestFileCacheFiles):
+    def runTest(self):
+        """Testing if a file read from the file cache is evicted last"""
+        for name in ['a', 'b', 'c', 'd', 'e']:
+            self._write_file(name)
+        for name in ['a', 'b', 'c', 'd', 'a', 'e']:
+            self._read_file(name)
+        self.failUnless(self.file_cache.hits == 1, 'Cached file read again.')
+        self.failUnless(self._get_cached_names() == ['a', 'c', 'd', 'e'], 'Wrong file evicted.')
+
+class TestFileCacheBudget(TestFileCacheFiles):
+    def runTest(self):
+        """Testing if the file cache evicts files once they exceed its size"""
+        for name in ['a', 'b', 'c', 'd', 'e', 'f']:
+            self._write_file(name)
+            self._read_file(name)
+            self.failUnless(self.file_cache.cached_bytes <= 400, 'Cache outgrew its size.')
+        self.failUnless(self.file_cache.evictions == 2 and self._get_cached_names() == ['c', 'd', 'e', 'f'], 'Wrong files evicted.')
+
+class TestFileCacheStat(TestFileCacheFiles):
+    def runTest(self):
+        """Testing if a cached file is read again after its modification time changed"""
+        self._write_file('a')
+        self._read_file('a')
+        self._write_file('a', char = 'y')
+        os.utime(os.path.join(self.filedir, 'a'), (1, 1))
+        self.failUnless(self._read_file('a')[0] == 'y' * 9 + '\n', 'Outdated file content returned.')
+        self.failUnless(self.file_cache.misses == 2 and self.file_cache.cached_bytes == 100, 'Outdated file still cached.')
+
+class TestFileCacheLargeFile(TestFileCacheFiles):
+    def runTest(self):
+        """Testing if a file larger than a quarter of the file cache is kept aside without evicting other files"""
+        for name in ['a', 'b', 'c']:
+            self._write_file(name)
+            self._read_file(name)
+        for name in ['large', 'larger']:
+            self._write_file(name, 30 + len(name))
+            self.failUnless(len(self._read_file(name)) == 30 + len(name), 'Large file read wrongly.')
+        self.failUnless(self._get_cached_names() == ['a', 'b', 'c'] and self.file_cache.cached_bytes == 300, 'Large file evicted other files.')
+        self._read_file('larger')
+        self.failUnless(self.file_cache.hits == 1 and self.file_cache.evictions == 1, 'Large file not kept aside.')
+
+class TestLinePool(TestEtcProposalsLib):
+    def runTest(self):
+        """Testing if lines shared by the config file and its proposal are stored once"""
+        proposal = etcproposals_lib.EtcProposals()[0]
+        base_lines = open(TESTCONFIGFILENAME).readlines()
+        proposed_lines = open(TESTCONFIGPROPOSALFILENAME).readlines()
+        self.failUnless(proposal.get_base_content() == base_lines, 'Pooled base lines differ.')
+        self.failUnless(proposal.get_proposed_content() == proposed_lines, 'Pooled proposed lines differ.')
+        self.failUnless(len(proposal.proposals.line_pool.lines) == len(set(base_lines + proposed_lines)), 'Lines are not shared in the pool.')
+
+class TestLinePoolLimit(TestEtcProposalsLib):
+    def runTest(self):
+        """Testing if a line pool outgrowing the cache size is replaced and contents stay lists"""
+        proposals = etcproposals_lib.EtcProposals()
+        proposal = proposals[0]
+        self.failUnless(isinstance(proposal.get_base_content(), list) and isinstance(proposal.get_proposed_content(), list), 'Contents are not lists.')
+        old_pool = proposals.line_pool
+        old_pool.size = etcproposals_lib.Config.MaxCachedBytes + 1
+        self.failIf(proposals.get_line_pool() is old_pool, 'Line pool outgrowing the cache size was kept.')
+        self.failUnless(proposal.get_proposed_content() == open(TESTCONFIGPROPOSALFILENAME).readlines(), 'Proposed lines differ after replacing the pool.')
+        self.failUnless(len(proposals.get_all_changes()) > 0, 'Changes lost after replacing the pool.')
+
+class TestLinePoolSize(unittest.TestCase):
+    def runTest(self):
+        """Testing if the size of the pooled lines is counted once per distinct line, also without sys.getsizeof"""
+        getsizeof = etcproposals_lib.getsizeof
+        try:
+            for etcproposals_lib.getsizeof in [getsizeof, None]:
+                line_pool = etcproposals_lib.EtcProposalsLinePool()
+                line_pool.intern_lines(['1\n', '22\n', '1\n'])
+                self.failUnless(line_pool.get_size() == etcproposals_lib.get_string_size('1\n') + etcproposals_lib.get_string_size('22\n'), 'Pool size miscounted.')
+            self.failUnless(line_pool.get_size() == 5 + 2 * etcproposals_lib.STRING_OVERHEAD, 'Pool size not estimated without sys.getsizeof.')
+        finally:
+            etcproposals_lib.getsizeof = getsizeof
+
+class TestRevisionChain(TestEtcProposalsLib):
+    def runTest(self):
+        """Testing if later revisions are only diffed again, if their base changed"""
+        open(TESTCONFIGLATERPROPOSALFILENAME, 'w').write(MODCONTENT + '\n14')
+        proposals = etcproposals_lib.EtcProposals()
+        (first_proposal, later_proposal) = proposals.get_file_proposals(TESTCONFIGFILENAME)
+        later_changes = later_proposal.get_changes()
+        first_proposal.get_changes()[0].zap()
+        self.failUnless(later_proposal.get_changes() == later_changes, 'Zapping rediffed the later revision.')
+        first_proposal.get_changes()[0].use()
+        self.failIf(later_proposal.get_changes() == later_changes, 'Using did not rediff the later revision.')
+        self.failUnless(later_proposal.get_base_content() == first_proposal.get_merged_content(), 'Later revision is based on an outdated merge.')
+
+class TestRevisionChainVersions(TestEtcProposalsLib):
+    def runTest(self):
+        """Testing if merged contents are only merged again after a decision on their revision"""
+        open(TESTCONFIGLATERPROPOSALFILENAME, 'w').write(MODCONTENT + '\n14')
+        # decisions of earlier tests on the same contents would be restored
+        for change in etcproposals_lib.EtcProposals().get_all_changes():
+            change.undo()
+        merges = list()
+        merge = etcproposals_lib.EtcProposal.merge
+        etcproposals_lib.EtcProposal.merge = lambda proposal: merges.append(proposal.get_revision()) or merge(proposal)
+        try:
+            proposals = etcproposals_lib.EtcProposals()
+            (first_proposal, later_proposal) = proposals.get_file_proposals(TESTCONFIGFILENAME)
+            later_proposal.get_changes()
+            later_proposal.get_merged_content()
+            later_proposal.get_merged_content()
+            self.failUnless(merges == [0, 1], 'Merged contents were not reused.')
+            for (operation, rediffed) in [('use', True), ('zap', True), ('undo', False)]:
+                del merges[:]
+                later_changes = later_proposal._changes
+                getattr(first_proposal.get_changes()[0], operation)()
+                later_proposal.get_changes()
+                self.failUnless(merges == [0], 'Merged content not merged again after %s.' % operation)
+                self.failUnless((later_proposal._changes is later_changes) != rediffed, 'Later revision diffed wrongly after %s.' % operation)
+            del merges[:]
+            later_proposal.get_changes()[0].use()
+            later_proposal.get_base_content()
+            self.failUnless(merges == [], 'Decision on the later revision merged the earlier one again.')
+        finally:
+            etcproposals_lib.EtcProposal.merge = merge
+
+class TestStateTables(TestEtcProposalsLib):
+    def runTest(self):
+        """Testing if config file md5s are kept in their own table and orphans are removed"""
+        configfile = etcproposals_lib.EtcProposalConfigFile(TESTCONFIGFILENAME)
+        configfile.update_unmodified(configfile.md5hexdigest())
+        state = etcproposals_lib.State
+        self.failUnless(configfile._get_state_url() in state.get_configfiles(), 'Config file md5 not in its table.')
+        self.failIf(configfile._get_state_url() in state.get_proposals(), 'Config file md5 listed as a proposal.')
+        proposal = etcproposals_lib.EtcProposals()[0]
+        proposal.get_changes()[0].use()
+        self.failUnless(proposal._get_state_url() in state.get_proposals(), 'Pending decision not listed.')
+        state.flush()
+        self.failUnless(state.get_proposals() == set(state._get_paths(None)), 'Decisions listed from other tables.')
+        os.unlink(TESTCONFIGFILENAME)
+        state.clear_orphaned_configfiles()
+        self.failIf(state.has_key(configfile._get_state_url()), 'Orphaned config file md5 not removed.')
+
+class TestStateFiles(unittest.TestCase):
+    STATEITEMS = [
+        ('EtcProposal://' + TESTCONFIGPROPOSALFILENAME, [('abc', 'use'), ('def', 'zap')]),
+        ('EtcProposalConfigFile://' + TESTCONFIGFILENAME, 'd41d8cd98f00b204e9800998ecf8427e'),
+        ('EtcProposalFingerprint://' + TESTCONFIGFILENAME, ((2049, 1234, 56, 1200000000.5), 'd41d8cd98f00b204e9800998ecf8427e'))]
+
+    def setUp(self):
+        self.statedir = tempfile.mkdtemp()
+        self.saved = (etcproposals_lib.SQLITESTATEFILE, etcproposals_lib.STATEFILE, etcproposals_lib.EtcProposalsShelveState.TABLEFILES)
+        etcproposals_lib.SQLITESTATEFILE = os.path.join(self.statedir, 'etcproposals.sqlite')
+        etcproposals_lib.STATEFILE = os.path.join(self.statedir, 'etcproposals.state')
+        etcproposals_lib.EtcProposalsShelveState.TABLEFILES = dict([(namespace, os.path.join(self.statedir, os.path.basename(tablefile)))
+            for (namespace, tablefile) in self.saved[2].iteritems()])
+
+    def tearDown(self):
+        (etcproposals_lib.SQLITESTATEFILE, etcproposals_lib.STATEFILE, etcproposals_lib.EtcProposalsShelveState.TABLEFILES) = self.saved
+        shutil.rmtree(self.statedir)
+
+    def _create_state(self):
+        return etcproposals_lib.EtcProposalsSqliteState(0)
+
+    def _create_shelve_state(self):
+        return etcproposals_lib.EtcProposalsShelveState(0)
+
+    def _write_legacy_state(self, items):
+        "writes a state file of the shelve backend, that had all namespaces in one table"
+        legacy_state = shelve.open(etcproposals_lib.STATEFILE, 'c')
+        for (key, value) in items:
+            legacy_state[key] = value
+        legacy_state.close()
+
+    def _check_items(self, state, items, message):
+        for (key, value) in items:
+            self.failUnless(state.has_key(key) and state[key] == value, message % key)
+
+
+class TestShelveStateSync(TestStateFiles):
+    def runTest(self):
+        """Testing if flushing the shelve state syncs every table"""
+        state = self._create_shelve_state()
+        synced = list()
+        for (namespace, table) in state.tables.iteritems():
+            table.sync = lambda namespace = namespace: synced.append(namespace)
+        for (key, value) in self.STATEITEMS:
+            state[key] = value
+        state.flush()
+        self.failUnless(sorted(synced) == sorted(state.tables.keys()), 'Not all tables were synced.')
+
+class TestFingerprintCache(TestEtcProposalsLib):
+    def runTest(self):
+        """Testing if md5s of recently modified files are not cached and the others are written with the next flush"""
+        state = etcproposals_lib.State
+        fingerprint_cache = etcproposals_lib.EtcProposalFingerprintCache(True)
+        url = fingerprint_cache._get_state_url(TESTCONFIGFILENAME)
+        md5 = fingerprint_cache.md5hexdigest(TESTCONFIGFILENAME)
+        self.failIf(fingerprint_cache.has_key(TESTCONFIGFILENAME) or state.has_key(url), 'md5 of a recently modified file cached.')
+        mtime = time.time() - 2 * fingerprint_cache.RACY_SECONDS
+        os.utime(TESTCONFIGFILENAME, (mtime, mtime))
+        fingerprint_cache.md5hexdigest(TESTCONFIGFILENAME)
+        self.failUnless(state.pending.has_key(url), 'md5 not deferred.')
+        self.failIf(state._has_value('EtcProposalFingerprint', TESTCONFIGFILENAME), 'md5 written before the flush.')
+        state.flush()
+        try:
+            self.failUnless(state._get_value('EtcProposalFingerprint', TESTCONFIGFILENAME)[1] == md5, 'md5 not written to its table.')
+            self.failIf(url in state._get_paths(None), 'md5 written to the decisions table.')
+            restarted_cache = etcproposals_lib.EtcProposalFingerprintCache(True)
+            self.failUnless(restarted_cache.md5hexdigest(TESTCONFIGFILENAME) == md5 and restarted_cache.misses == 0, 'md5 not restored.')
+        finally:
+            del state[url]
+            state.flush()
+
+class TestSqliteStateTables(TestStateFiles):
+    def runTest(self):
+        """Testing if every table of the sqlite state keeps its values across restarts"""
+        if etcproposals_lib.sqlite3 is None:
+            return
+        state = self._create_state()
+        for (key, value) in self.STATEITEMS:
+            state[key] = value
+        state.flush()
+        self._check_items(self._create_state(), self.STATEITEMS, '%s not restored.')
+        self.failUnless(sorted(self._create_state().keys()) == sorted([key for (key, value) in self.STATEITEMS]), 'Keys listed wrongly.')
+        for (key, value) in self.STATEITEMS:
+            del state[key]
+        state.flush()
+        self.failIf(self._create_state().keys(), 'Deleted keys restored.')
+
+class TestSqliteStateMigration(TestStateFiles):
+    def runTest(self):
+        """Testing if a shelve state is migrated to the sqlite state only when the database is created"""
+        if etcproposals_lib.sqlite3 is None:
+            return
+        self._write_legacy_state(self.STATEITEMS)
+        state = self._create_state()
+        self._check_items(state, self.STATEITEMS, '%s not migrated.')
+        (key, value) = self.STATEITEMS[0]
+        del state[key]
+        state.flush()
+        self._write_legacy_state([('EtcProposal://' + TESTCONFIGLATERPROPOSALFILENAME, [('ghi', 'use')])])
+        restarted_state = self._create_state()
+        self.failIf(restarted_state.has_key(key), 'Migration ran again and restored a deleted key.')
+        self.failIf(restarted_state.has_key('EtcProposal://' + TESTCONFIGLATERPROPOSALFILENAME), 'Migration ran again.')
+        self._check_items(restarted_state, self.STATEITEMS[1:], '%s lost on restart.')
+
+class TestDiffCacheKeys(TestEtcProposalsLib):
+    def runTest(self):
+        """Testing if diffs are cached by the contents, the diff engine and the change limit"""
+        config = etcproposals_lib.Config
+        proposal = etcproposals_lib.EtcProposals()[0]
+        changes = proposal.get_changes()
+        key = proposal._get_diff_cache_key()
+        cached_diff = etcproposals_lib.DiffCache.lookup(key)
+        self.failUnless(cached_diff and [opcode for opcode in cached_diff[0] if opcode[0] != 'equal'] == [change.opcode for change in changes], 'Diff not cached.')
+        (engine, max_changes) = (config.DiffEngine, config.MaxChangesPerProposal)
+        try:
+            config.DiffEngine = {'difflib' : 'myers', 'myers' : 'difflib'}[engine]
+            self.failIf(etcproposals_lib.EtcProposals()[0]._get_diff_cache_key() == key, 'Diff engine not in the key.')
+            config.DiffEngine = engine
+            config._EtcProposalsConfig__max_changes_per_proposal = max_changes + 1
+            self.failIf(etcproposals_lib.EtcProposals()[0]._get_diff_cache_key() == key, 'Change limit not in the key.')
+        finally:
+            (config.DiffEngine, config._EtcProposalsConfig__max_changes_per_proposal) = (engine, max_changes)
+
+class TestDiffCacheFiles(unittest.TestCase):
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.cachepath = os.path.join(self.cachedir, 'etcproposals.diffcache')
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def _create_cache(self, max_bytes = 1024 * 1024):
+        return etcproposals_lib.EtcProposalsDiffCache(self.cachepath, 1, max_bytes)
+
+    def _store(self, diff_cache, key, age):
+        diff_cache.store(key, [('replace', 0, 1, 0, 1)], [0])
+        diff_cache.index[key] = (time.time() - age, diff_cache.index[key][1])
+
+class TestDiffCacheStale(TestDiffCacheFiles):
+    def runTest(self):
+        """Testing if expired diffs are removed when the diff cache is opened and the others are kept"""
+        diff_cache = self._create_cache()
+        self._store(diff_cache, 'expired', etcproposals_lib.EtcProposalsDiffCache.SECONDS_PER_DAY + 1)
+        self._store(diff_cache, 'recent', 1)
+        diff_cache.flush()
+        reopened_cache = self._create_cache()
+        self.failIf(reopened_cache.has_key('expired') or reopened_cache.db.has_key('expired'), 'Expired diff not removed on open.')
+        self.failUnless(reopened_cache.lookup('recent') == ([('replace', 0, 1, 0, 1)], [0]), 'Recent diff not restored.')
+
+class TestDiffCacheSize(TestDiffCacheFiles):
+    def runTest(self):
+        """Testing if the least recently used diffs are removed once the diff cache outgrows its size"""
+        diff_cache = self._create_cache()
+        self._store(diff_cache, 'older', 3)
+        entry_size = diff_cache.index['older'][1]
+        diff_cache = self._create_cache(2 * entry_size)
+        self._store(diff_cache, 'older', 3)
+        self._store(diff_cache, 'newer', 2)
+        diff_cache.lookup('older')
+        self._store(diff_cache, 'newest', 1)
+        self.failUnless(sorted(diff_cache.index.keys()) == ['newest', 'older'], 'Wrong diff removed.')
+        self.failUnless(diff_cache.cached_bytes == 2 * entry_size, 'Cached bytes miscounted.')
+
+class TestDiffCacheIndex(TestDiffCacheFiles):
+    def runTest(self):
+        """Testing if diffs stored after the index was written last are dropped when the diff cache is opened"""
+        diff_cache = self._create_cache()
+        self._store(diff_cache, 'flushed', 1)
+        diff_cache.flush()
+        self._store(diff_cache, 'unflushed', 1)
+        diff_cache.db.close()
+        reopened_cache = self._create_cache()
+        self.failUnless(reopened_cache.has_key('flushed'), 'Indexed diff lost.')
+        self.failIf(reopened_cache.has_key('unflushed') or reopened_cache.db.has_key('unflushed'), 'Unindexed diff kept.')
+
+class TestShiftedDecisions(TestEtcProposalsLib):
+    def runTest(self):
+        """Testing if decisions are restored after the changes moved to other lines"""
+        statuses = list()
+        for (change, operation) in zip(etcproposals_lib.EtcProposals().get_all_changes(), ['use', 'zap']):
+            getattr(change, operation)()
+            statuses.append(change.get_status())
+        open(TESTCONFIGFILENAME , 'w').write('0\n' + BASECONTENT)
+        open(TESTCONFIGPROPOSALFILENAME, 'w').write('0\n' + MODCONTENT)
+        restored_statuses = [change.get_status() for change in etcproposals_lib.EtcProposals().get_all_changes()]
+        self.failUnless(restored_statuses[:len(statuses)] == statuses, 'Decisions were lost.')
+
+class TestApplyRecovery(TestEtcProposalsLib):
+    def runTest(self):
+        """Testing if an apply interrupted after committing its journal is finished on refresh"""
+        journal = etcproposals_lib.ApplyJournal
+        journal._commit = lambda entries: None
+        try:
+            journal.apply([(TESTCONFIGFILENAME, [MODCONTENT], [TESTCONFIGPROPOSALFILENAME])])
+        finally:
+            del journal._commit
+        self.failUnless(self._has_filecontent(TESTCONFIGFILENAME, BASECONTENT), 'Config file changed before commit.')
+        etcproposals_lib.EtcProposals()
+        self.failUnless(self._has_filecontent(TESTCONFIGFILENAME, MODCONTENT), 'Interrupted apply not finished.')
+        self.failIf(os.path.exists(TESTCONFIGPROPOSALFILENAME), 'Applied proposal not removed.')
+
+class TestApplyRebase(TestEtcProposalsLib):
+    def runTest(self):
+        """Testing if applying a revision rebases the later one without a refresh"""
+        open(TESTCONFIGLATERPROPOSALFILENAME, 'w').write(MODCONTENT + '\n14')
+        proposals = etcproposals_lib.EtcProposals()
+        for change in proposals.get_file_proposals(TESTCONFIGFILENAME)[0].get_changes():
+            change.use()
+        proposals.apply()
+        self.failUnless(len(proposals) == 1, 'Applied proposal still in the model.')
+        self.failUnless(proposals[0].get_base_content() == open(TESTCONFIGFILENAME).readlines(), 'Later revision not rebased.')
+        self.failUnless(len(proposals.get_all_changes()) == 1, 'Later revision has the wrong changes.')
+
+class TestEditedProposal(TestEtcProposalsLib):
+    def runTest(self):
+        """Testing if a proposal edited after diffing is diffed again before applying"""
+        proposals = etcproposals_lib.EtcProposals()
+        for change in proposals.get_all_changes():
+            change.use()
+        open(TESTCONFIGPROPOSALFILENAME, 'w').write(MODCONTENT + '\n14')
+        self.failIf(proposals[0].is_finished(), 'Decisions on the old proposal content still count.')
+        for change in proposals.get_all_changes():
+            change.use()
+        proposals.apply()
+        self.failUnless(self._has_filecontent(TESTCONFIGFILENAME, MODCONTENT + '\n14'), 'Old changes were applied to the edited proposal.')
+
+class TestScanCache(TestEtcProposalsLib):
+    def runTest(self):
+        """Testing if proposals added after a scan are found by the next one"""
+        self.failUnless(len(etcproposals_lib.EtcProposals()) == 1, 'Proposal not found.')
+        open(TESTCONFIGLATERPROPOSALFILENAME, 'w').write(MODCONTENT + '\n14')
+        self.failUnless(len(etcproposals_lib.EtcProposals()) == 2, 'Scan cache hid a new proposal.')
+
+class TestScannerFiles(unittest.TestCase):
+    PROPOSALS = ['._cfg0000_a.conf', 'sub/._cfg0000_b.conf', 'sub/deep/._cfg0000_c.conf',
+        'skip.d/._cfg0000_d.conf', 'masked/._cfg0000_e.conf']
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for proposal in self.PROPOSALS:
+            if not os.path.isdir(os.path.dirname(self._get_path(proposal))):
+                os.makedirs(os.path.dirname(self._get_path(proposal)))
+            open(self._get_path(proposal), 'w').close()
+        # directories modified that recently would not be cached
+        for (dir, dirs, files) in os.walk(self.root):
+            os.utime(dir, (1, 1))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _get_path(self, relative_path):
+        return os.path.join(self.root, relative_path)
+
+    def _scan(self, prune_globs = [], max_depth = 0, masks = []):
+        "returns the proposals found below the root relative to it"
+        scanner = etcproposals_lib.EtcProposalsScanner(self._get_path('scancache'), 1, prune_globs, max_depth)
+        proposal_paths = scanner.scan([self.root], [self._get_path(mask) for mask in masks])[0]
+        return sorted([proposal_path[len(self.root) + 1:] for proposal_path in proposal_paths])
+
+    def _get_proposals_except(self, *names):
+        return sorted([proposal for proposal in self.PROPOSALS if not proposal.split('_', 2)[-1][0] in names])
+
+class TestScanPruneGlobs(TestScannerFiles):
+    def runTest(self):
+        """Testing if directories matching a prune glob are not scanned"""
+        self.failUnless(self._scan(['*/skip.d']) == self._get_proposals_except('d'), 'Pruned directory scanned.')
+        self.failUnless(self._scan(['*/sub']) == self._get_proposals_except('b', 'c'), 'Pruned subtree scanned.')
+        self.failUnless(self._scan(['*/nomatch*']) == sorted(self.PROPOSALS), 'Unmatched directory pruned.')
+
+class TestScanMaxDepth(TestScannerFiles):
+    def runTest(self):
+        """Testing if directories deeper than the maximal depth are not scanned"""
+        self.failUnless(self._scan(max_depth = 1) == self._get_proposals_except('c'), 'Too deep directory scanned.')
+        self.failUnless(self._scan(max_depth = 2) == sorted(self.PROPOSALS), 'Directory within the depth skipped.')
+        self.failUnless(self._scan(max_depth = 0) == sorted(self.PROPOSALS), 'Unlimited depth limited.')
+
+class TestScanMask(TestScannerFiles):
+    def runTest(self):
+        """Testing if proposals for files and directories in CONFIG_PROTECT_MASK are skipped, also when the directories are cached"""
+        self.failUnless(self._scan() == sorted(self.PROPOSALS), 'Proposal not found.')
+        self.failUnless(self._scan(masks = ['masked']) == self._get_proposals_except('e'), 'Proposal in masked directory found.')
+        self.failUnless(self._scan(masks = ['a.conf', 'sub/deep/']) == self._get_proposals_except('a', 'c'), 'Proposal for masked file found.')
+        self.failUnless(self._scan(masks = ['']) == [], 'Masked root scanned.')
+        self.failUnless(self._scan() == sorted(self.PROPOSALS), 'Proposal not found after unmasking.')
+
 class TestFileScan(TestEtcProposalsLib):
     def runTest(self):
         """Testing if scanning all config files for modifications (comparing to vdb) works"""
 	etcproposals_lib.EtcProposals.scan_all_files()
 
 
-alltests = [TestUseAll(), TestZapAll(), TestUndoAll(), TestWhitespaceonly(), TestCVSHeader(), TestFileScan()]
+alltests = [TestUseAll(), TestZapAll(), TestUndoAll(), TestStatusBuckets(), TestWhitespaceonly(), TestCVSHeader(), TestParallelDiff(), TestDirChanges(), TestLineBuffer(), TestLineBufferTruncation(), TestFileCacheLRU(), TestFileCacheBudget(), TestFileCacheStat(), TestFileCacheLargeFile(), TestLinePool(), TestLinePoolLimit(), TestLinePoolSize(), TestRevisionChain(), TestRevisionChainVersions(), TestStateTables(), TestShelveStateSync(), TestFingerprintCache(), TestSqliteStateTables(), TestSqliteStateMigration(), TestDiffCacheKeys(), TestDiffCacheStale(), TestDiffCacheSize(), TestDiffCacheIndex(), TestShiftedDecisions(), TestApplyRecovery(), TestApplyRebase(), TestEditedProposal(), TestScanCache(), TestScanPruneGlobs(), TestScanMaxDepth(), TestScanMask(), TestFileScan()]
 alltestssuite = unittest.TestSuite(alltests)
 
 if __name__ == '__main__':
@@ -0,0 +1,21 @@
+#! /usr/bin/python
+import unittest
+from etcproposals.etcproposals_readline import EtcProposalShellDecorator, EtcProposalChangeShellDecorator
+
+TESTCONFIGPROPOSALFILENAME = '/etc/._cfg0000_etcproposalsTESTCONFIG'
+
+
+class TestDecoratorSlots(unittest.TestCase):
+    def runTest(self):
+        """Testing if the decorated proposals and changes are slotted like the ones they decorate"""
+        proposal = EtcProposalShellDecorator(TESTCONFIGPROPOSALFILENAME, None)
+        change = EtcProposalChangeShellDecorator(('replace', 0, 1, 0, 1), proposal)
+        self.failIf(hasattr(proposal, '__dict__'), 'Decorated proposal has a __dict__.')
+        self.failIf(hasattr(change, '__dict__'), 'Decorated change has a __dict__.')
+
+
+alltests = [TestDecoratorSlots()]
+alltestssuite = unittest.TestSuite(alltests)
+
+if __name__ == '__main__':
+    unittest.main()
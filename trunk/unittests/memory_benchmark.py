@@ -0,0 +1,53 @@
+#! /usr/bin/python
+# compares the memory used by the slotted proposal, change and vdb records
+# with dict backed objects holding the same attributes and the time needed
+# to sort the proposals by their precomputed key
+import sys, time, random
+from etcproposals.etcproposals_lib import EtcProposal, EtcProposalChange
+from etcproposals.portage_stubs import PortagePkgPartObject
+
+CHANGES = 10000
+CHANGES_PER_PROPOSAL = 10
+
+class DictBacked(object):
+    pass
+
+def get_slots(cls):
+    return [slot for klass in cls.__mro__ for slot in getattr(klass, '__slots__', [])]
+
+def get_size(obj):
+    if hasattr(obj, '__dict__'):
+        return sys.getsizeof(obj) + sys.getsizeof(obj.__dict__)
+    return sys.getsizeof(obj)
+
+def get_dict_backed(obj):
+    dict_backed = DictBacked()
+    for slot in get_slots(type(obj)):
+        setattr(dict_backed, slot, getattr(obj, slot))
+    return dict_backed
+
+def create_records(count):
+    proposals = [EtcProposal('/etc/dir%d/._cfg%04d_file%d.conf' % (index % 50, index % 3, index), None)
+        for index in xrange(count / CHANGES_PER_PROPOSAL)]
+    changes = [EtcProposalChange(('replace', index, index + 1, index, index + 1), proposals[index / CHANGES_PER_PROPOSAL])
+        for index in xrange(count)]
+    pkgparts = [PortagePkgPartObject('obj /etc/dir%d/file%d.conf d41d8cd98f00b204e9800998ecf8427e 1200000000' % (index % 50, index), '', '', '')
+        for index in xrange(count)]
+    return (proposals, changes, pkgparts)
+
+def benchmark_sort(proposals, rounds):
+    starttime = time.time()
+    for round in range(rounds):
+        random.shuffle(proposals)
+        proposals.sort(key = lambda proposal: proposal.sort_key)
+    return (time.time() - starttime) / rounds
+
+if __name__ == '__main__':
+    (proposals, changes, pkgparts) = create_records(CHANGES)
+    print '%d proposals, %d changes, %d vdb records' % (len(proposals), len(changes), len(pkgparts))
+    for (name, records) in [('proposal', proposals), ('change', changes), ('vdb record', pkgparts)]:
+        slotted = sum([get_size(record) for record in records])
+        dict_backed = sum([get_size(get_dict_backed(record)) for record in records])
+        print '%s%6d bytes slotted, %6d bytes dict backed per object, %9d bytes saved in total' % (
+            name.ljust(12), slotted / len(records), dict_backed / len(records), dict_backed - slotted)
+    print 'sorting %d proposals%8.4fs' % (len(proposals), benchmark_sort(proposals, 10))
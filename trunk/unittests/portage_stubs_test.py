@@ -1,7 +1,8 @@
 #! /usr/bin/python
 import unittest
-from etcproposals.portage_stubs import PortageInterface
+from etcproposals.portage_stubs import PortageInterface, PortageConfig, InstalledPkgDB, InstalledPkgIndex
 import portage
+import os, os.path, shutil, tempfile
 
 class Test_get_md5_from_vdb(unittest.TestCase):
     def runTest(self):
@@ -15,6 +16,70 @@ class Test_get_md5_from_vdb(unittest.TestCase):
         self.failUnless(md5s.has_key(issue), 'Didnt find an entry in the pkgdb: "%s"' % issue)
         self.failUnless(md5s.has_key(hostname), 'Didnt find an entry in the pkgdb: "%s"' % hostname)
     
+class Test_vdb_index(unittest.TestCase):
+    def runTest(self):
+        """Testing if the vdb index yields the same fileinfo as parsing the vdb"""
+        files = set(['/etc/issue', '/etc/conf.d/hostname', '/some nonexsistant file'])
+        indexed = PortageInterface.get_fileinfo_from_vdb(files, 1, ['/etc'])
+        scanned = PortageInterface.scan_vdb(files)
+        self.failUnless(set(indexed.keys()) == set(scanned.keys()), 'Index found other files than the vdb scan.')
+        for path in scanned.keys():
+            self.failUnless((indexed[path].md5, indexed[path].mtime) == (scanned[path].md5, scanned[path].mtime), 'Index differs for "%s".' % path)
+
+class Test_vdb_index_stamp(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbpath = os.path.join(self.tmpdir, 'pkg')
+        self.counter_path = os.path.join(self.tmpdir, 'counter')
+        self.indexpath = os.path.join(self.tmpdir, 'vdbindex')
+        self._merge('app-misc/foo-1', 1, ['/etc/foo.conf', '/usr/bin/foo'])
+        self.index = InstalledPkgIndex(['/etc'], self.indexpath, self.dbpath, 1, self.counter_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _merge(self, package, counter, paths):
+        pkgdbpath = os.path.join(self.dbpath, package)
+        os.makedirs(pkgdbpath)
+        open(os.path.join(pkgdbpath, 'COUNTER'), 'w').write('%d\n' % counter)
+        open(os.path.join(pkgdbpath, 'CONTENTS'), 'w').write(''.join(['obj %s %032d %d\n' % (path, counter, counter) for path in paths]))
+        open(self.counter_path, 'w').write('%d\n' % counter)
+
+    def runTest(self):
+        """Testing if the vdb index records protected paths and is only updated after merges"""
+        self.failUnless(self.index.get_fileinfo(['/etc/foo.conf'])['/etc/foo.conf'].md5 == '%032d' % 1, 'Index misses a protected file.')
+        self.failIf(self.index._load_index()['paths'].has_key('/usr/bin/foo'), 'Index records an unprotected file.')
+        os.remove(os.path.join(self.dbpath, 'app-misc/foo-1/CONTENTS'))
+        self._merge('app-misc/baz-1', 1, ['/etc/baz.conf'])
+        fileinfo = self.index.get_fileinfo(['/etc/foo.conf', '/etc/baz.conf'])
+        self.failUnless(fileinfo.has_key('/etc/foo.conf') and not fileinfo.has_key('/etc/baz.conf'), 'Index was updated without a merge.')
+        open(self.indexpath + '.new', 'w').write('half written')
+        self._merge('app-misc/bar-1', 2, ['/etc/bar.conf'])
+        fileinfo = self.index.get_fileinfo(['/etc/foo.conf', '/etc/bar.conf'])
+        self.failUnless(fileinfo.has_key('/etc/foo.conf') and fileinfo.has_key('/etc/bar.conf'), 'Index was not updated after a merge.')
+        shutil.rmtree(os.path.join(self.dbpath, 'app-misc/bar-1'))
+        os.utime(self.dbpath, (0, 0))
+        self.failIf(self.index.get_fileinfo(['/etc/bar.conf']).has_key('/etc/bar.conf'), 'Index was not updated after an unmerge.')
+
+class Test_parallel_vdb_scan(unittest.TestCase):
+    def runTest(self):
+        """Testing if parsing the vdb in worker processes yields the same fileinfo"""
+        files = set(['/etc/issue', '/etc/conf.d/hostname', '/some nonexsistant file'])
+        serial = PortageInterface.scan_vdb(files, 1)
+        parallel = PortageInterface.scan_vdb(files, 2)
+        self.failUnless(dict([(path, pkgpart.md5) for (path, pkgpart) in serial.iteritems()]) ==
+            dict([(path, pkgpart.md5) for (path, pkgpart) in parallel.iteritems()]), 'Parallel vdb scan differs.')
+
+class Test_installed_pkgs(unittest.TestCase):
+    def runTest(self):
+        """Testing package enumeration"""
+        pkgs = list(InstalledPkgDB().installed_pkgs())
+        portage_cpvs = set(portage.db['/']['vartree'].dbapi.cpv_all())
+        self.failUnless(set(['%s/%s' % (os.path.basename(os.path.dirname(pkg.dbpath)), pkg.pf()) for pkg in pkgs]) == portage_cpvs, 'Enumerated packages differ from the ones portage knows.')
+        latest_counter = max([pkg.counter() for pkg in pkgs])
+        self.failUnless(len(InstalledPkgDB().changed_since(latest_counter - 1)) == 1, 'Last merged package not found.')
+        self.failUnless(len(InstalledPkgDB().changed_since(latest_counter)) == 0, 'Found packages merged later than the last one.')
+
 class Test_get_config_protect(unittest.TestCase):
     def runTest(self):
         """Testing CONFIG_PROTECT calculation"""
@@ -22,7 +87,21 @@ class Test_get_config_protect(unittest.TestCase):
         stubs_config_protect = set(PortageInterface.get_config_protect('portage'))
         self.failUnless(stubs_config_protect == portage_config_protect, 'Calculated CONFIG_PROTECT differs from the one calculated by portage.')
 
-alltests = [Test_get_config_protect(), Test_get_md5_from_vdb()]
+class Test_get_config_protect_mask(unittest.TestCase):
+    def runTest(self):
+        """Testing CONFIG_PROTECT_MASK calculation"""
+        portage_config_protect_mask = set(portage.settings['CONFIG_PROTECT_MASK'].split())
+        stubs_config_protect_mask = set(PortageInterface.get_config_protect_and_mask('portage')[1])
+        self.failUnless(stubs_config_protect_mask == portage_config_protect_mask, 'Calculated CONFIG_PROTECT_MASK differs from the one calculated by portage.')
+
+class Test_PortageConfig(unittest.TestCase):
+    def runTest(self):
+        """Testing CONFIG_PROTECT calculation without starting portage"""
+        (config_protect, config_protect_mask) = PortageConfig.get_config_protect_and_mask()
+        self.failUnless(set(config_protect) == set(portage.settings['CONFIG_PROTECT'].split()), 'CONFIG_PROTECT differs from the one calculated by portage.')
+        self.failUnless(set(config_protect_mask) == set(portage.settings['CONFIG_PROTECT_MASK'].split()), 'CONFIG_PROTECT_MASK differs from the one calculated by portage.')
+
+alltests = [Test_get_config_protect(), Test_get_config_protect_mask(), Test_PortageConfig(), Test_get_md5_from_vdb(), Test_vdb_index(), Test_vdb_index_stamp(), Test_parallel_vdb_scan(), Test_installed_pkgs()]
 alltestssuite = unittest.TestSuite(alltests)
 
 if __name__ == '__main__':